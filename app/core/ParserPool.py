@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from app.core.csvIngest import DEFAULT_BATCH_SIZE, iterLineProtocolBatches, logDiscovered
+from app.tools.Settings import SettingsIndex
+from app.tools.TimestampConverter import TimestampConverter
+
+logger = logging.getLogger(__name__)
+
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', 0))  # 0 disables the process pool
+_TIMESTAMP_COUNTERS = ("hits", "misses", "ambiguous", "nonexistent")
+
+# worker process state, filled once by _initWorker when the pool starts
+_enabled_data_points: dict = {}
+_enabled_ids = None
+_disabled_data_points = []
+_high_water_marks: Optional[Dict[str, int]] = None
+
+
+def _initWorker(enabled_data_points: dict, disabled_data_points, enabled_ids, high_water_marks: Optional[Dict[str, int]]) -> None:
+    global _enabled_data_points, _disabled_data_points, _enabled_ids, _high_water_marks
+    _enabled_data_points = enabled_data_points
+    _disabled_data_points = disabled_data_points
+    _enabled_ids = enabled_ids
+    _high_water_marks = high_water_marks
+
+
+# runs in the worker: csv chunk bytes (header line first) -> ([(points in batch, line protocol bytes)], {id: latest point},
+# row counts, {id: meter name} of data points that are not enabled, (worker pid, timestamp cache stats of the worker))
+def _encodeFile(data: bytes, batch_size: int = DEFAULT_BATCH_SIZE) \
+        -> Tuple[List[Tuple[int, bytes]], Dict[str, Tuple[int, float]], Dict[str, int], Dict[str, str], Tuple[int, dict]]:
+    lines = data.decode('utf-8').splitlines()
+    written_data_points = {}
+    row_counts = {}
+    # logged by the app process, INFO records of the workers are not collected
+    discovered_names = {}
+    batches = [
+        (len(batch), "\n".join(batch).encode('utf-8'))
+        for batch in iterLineProtocolBatches(lines, _enabled_data_points, _disabled_data_points, set(),
+                                             batch_size=batch_size, written_data_points=written_data_points, high_water_marks=_high_water_marks,
+                                             row_counts=row_counts, enabled_ids=_enabled_ids, discovered_names=discovered_names)
+    ]
+    return batches, written_data_points, row_counts, discovered_names, (os.getpid(), TimestampConverter().stats())
+
+
+# Singleton process pool that parses csv files and encodes line protocol outside of the GIL of the app process
+class ParserPool:
+    _instance: Optional['ParserPool'] = None
+    _lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs) -> 'ParserPool':
+        if not cls._instance:
+            cls._instance = super(ParserPool, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.processes = PARSE_PROCESSES
+            self.executor = None
+            self.index = None
+            # timestamp caches live in the workers: latest stats per worker pid, counters of workers already stopped
+            self._worker_stats: Dict[int, dict] = {}
+            self._stopped_counters = dict.fromkeys(_TIMESTAMP_COUNTERS, 0)
+            self.initialized = True
+
+    def is_enabled(self) -> bool:
+        return self.processes > 0
+
+    # (re)start the pool when the settings index changed or high-water marks are given (they change with every run);
+    # tables and marks are sent to the workers only here, tasks carry just the csv chunk
+    def start(self, index: SettingsIndex, high_water_marks: Optional[Dict[str, int]] = None) -> None:
+        with self._lock:
+            if self.executor is not None and self.index is index and high_water_marks is None:
+                return
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self._retireWorkers()
+            logger.info(f"Starting parser pool with {self.processes} processes")
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                # spawn, forking a process that runs uvicorn and the scheduler threads is not safe
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initWorker,
+                # the tables, not the index itself: its read-only mappings can not be pickled
+                initargs=(index.enabled_data_points, index.disabled_data_points, index.enabled_ids, high_water_marks),
+            )
+            self.index = index
+
+    # data points that are not enabled are logged here, once per id of discovered_data_points
+    def encode(self, data: bytes, discovered_data_points: set,
+               batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[List[Tuple[int, bytes]], Dict[str, Tuple[int, float]], Dict[str, int]]:
+        batches, data_points, row_counts, discovered_names, (pid, stats) = self.executor.submit(_encodeFile, data, batch_size).result()
+        self._worker_stats[pid] = stats
+        logDiscovered(discovered_names, discovered_data_points)
+        return batches, data_points, row_counts
+
+    # TimestampConverter().stats() summed over the worker processes, the cache of the app process is not used by the pool
+    def timestamp_stats(self) -> dict:
+        workers = list(self._worker_stats.values())
+        stats = {key: self._stopped_counters[key] + sum(s[key] for s in workers) for key in _TIMESTAMP_COUNTERS}
+        stats["size"] = sum(s["size"] for s in workers)
+        stats["workers"] = len(workers)
+        return stats
+
+    def _retireWorkers(self) -> None:
+        for stats in self._worker_stats.values():
+            for key in _TIMESTAMP_COUNTERS:
+                self._stopped_counters[key] += stats[key]
+        self._worker_stats = {}
+
+    def stop(self) -> None:
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+                self._retireWorkers()
@@ -0,0 +1,271 @@
+import os
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from app.core.csvIngest import addRowCounts, iterCsvChunks, iterDecodedLines, iterLineProtocolBatches
+from app.core.ParserPool import ParserPool
+from app.microservicies.InfluxWriter import INFLUX_BATCH_SIZE, INFLUX_WRITE_CONCURRENCY
+from app.tools import metrics
+from app.tools.LatestValueStore import LatestValueStore, mergeLatest
+from app.tools.QueryCache import QueryCache
+from app.tools.Settings import SettingsIndex
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 4))
+PARSE_CONCURRENCY = int(os.getenv('PARSE_CONCURRENCY', 2))
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', 16))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 1024 * 1024))
+DOWNLOAD_BUFFER_CHUNKS = int(os.getenv('DOWNLOAD_BUFFER_CHUNKS', 8))  # chunks read ahead of the parser per file
+# skip rows not newer than the latest ingested point of their data point, overlapping exports then cost only their new rows;
+# rows backfilled behind the latest point are skipped too, leave it off when older data can arrive later.
+# The marks are the latest values acknowledged by InfluxDB, persisted to LATEST_VALUES_FILE (latest_values.sqlite by default)
+SKIP_INGESTED_ROWS = os.getenv('SKIP_INGESTED_ROWS', 'False').lower() == 'true'
+
+FILE_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+rows_parsed = metrics.counter("csv_rows_parsed_total", "CSV rows parsed by the processing pipeline")
+rows_skipped = metrics.counter("csv_rows_skipped_total", "CSV rows of data points that are not enabled or without a numeric value")
+rows_ingested = metrics.counter("csv_rows_already_ingested_total", "CSV rows skipped because they were ingested before (SKIP_INGESTED_ROWS)")
+points_queued = metrics.counter("csv_points_total", "Points encoded from CSV rows and queued for writing")
+files_processed = metrics.counter("processing_files_total", "Files fully written to InfluxDB")
+files_failed = metrics.counter("processing_files_failed_total", "Files that could not be downloaded, parsed or written")
+file_parse_seconds = metrics.histogram("processing_file_parse_seconds",
+                                       "Time spent downloading and parsing a file, waits for the write queue excluded", FILE_BUCKETS)
+file_write_seconds = metrics.histogram("processing_file_write_seconds",
+                                       "Time spent writing the batches of a file to InfluxDB, summed over writer threads", FILE_BUCKETS)
+file_seconds = metrics.histogram("processing_file_seconds", "Time from the start of the download until a file is written", FILE_BUCKETS)
+write_queue_depth = metrics.gauge("processing_write_queue_depth", "Batches waiting for a writer, sampled when a batch is queued")
+
+
+# state of one S3 object moving through the pipeline
+class _FileJob:
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.points = 0
+        self.data_points = {}  # id -> (timestamp ns, value) of the latest point
+        self.row_counts = {}
+        # body chunks read ahead by the download thread, ended by None or the download error
+        self.chunks = queue.Queue(maxsize=max(1, DOWNLOAD_BUFFER_CHUNKS))
+        self.read = False
+        self.cancelled = False
+        self.started = time.perf_counter()
+        self.parse_seconds = 0.0
+        self.write_seconds = 0.0
+        self.parsed = False
+        self.spilled = False  # some batches wait in the spill queue, InfluxDB has not acknowledged them
+        self.failed = False
+        self.done = False
+
+
+# Staged processing of S3 files: download pool -> bounded chunk buffer -> parse pool -> bounded write queue -> tagging.
+# A file is tagged as processed only after every batch parsed from it was written to InfluxDB.
+class ProcessingPipeline:
+    def __init__(self, s3connector, writer,
+                 download_concurrency: int = DOWNLOAD_CONCURRENCY,
+                 parse_concurrency: int = PARSE_CONCURRENCY,
+                 write_concurrency: int = INFLUX_WRITE_CONCURRENCY,
+                 write_queue_size: int = WRITE_QUEUE_SIZE,
+                 parser_pool: Optional[ParserPool] = None) -> None:
+        self.s3connector = s3connector
+        self.writer = writer
+        self.download_concurrency = max(1, download_concurrency)
+        self.parse_concurrency = max(1, parse_concurrency)
+        self.parser_pool = parser_pool if parser_pool is not None and parser_pool.is_enabled() else None
+        if self.parser_pool is not None:
+            # parse threads only dispatch to the pool, keep every process busy
+            self.parse_concurrency = max(self.parse_concurrency, self.parser_pool.processes)
+        self.write_concurrency = max(1, write_concurrency)
+        self.write_queue_size = max(1, write_queue_size)
+
+    # process all files, returns number of files marked as processed
+    # index is one snapshot of the settings, a reload during the run does not mix tables of two versions
+    def run(self, files: Iterable[str], index: SettingsIndex) -> int:
+        self.enabled_data_points = index.enabled_data_points
+        self.enabled_ids = index.enabled_ids
+        self.disabled_data_points = index.disabled_data_points
+        self.discovered_data_points = set()
+        if self.parser_pool is not None:
+            # the workers get the marks once per run, files completed during the run do not move them there
+            self.parser_pool.start(index, LatestValueStore().high_water_marks() if SKIP_INGESTED_ROWS else None)
+        self.processed = 0
+        self.files = 0
+        self.write_queue = queue.Queue(maxsize=self.write_queue_size)
+        self.tag_queue = queue.Queue()
+        # limits files that are downloaded but not parsed yet, so downloads cannot run away from parsing
+        self.in_flight = threading.BoundedSemaphore(self.download_concurrency + self.parse_concurrency)
+
+        writers = [threading.Thread(target=self._writer, name=f"influx-writer-{i}") for i in range(self.write_concurrency)]
+        tagger = threading.Thread(target=self._tagger, name="s3-tagger")
+        for t in writers + [tagger]:
+            t.start()
+        try:
+            with ThreadPoolExecutor(self.parse_concurrency, thread_name_prefix="csv-parser") as parsers:
+                with ThreadPoolExecutor(self.download_concurrency, thread_name_prefix="s3-download") as downloads:
+                    for file in files:
+                        self.in_flight.acquire()
+                        self.files += 1
+                        downloads.submit(self._download, _FileJob(file), parsers)
+        finally:
+            for _ in writers:
+                self.write_queue.put(None)
+            for t in writers:
+                t.join()
+            self.tag_queue.put(None)
+            tagger.join()
+        return self.processed
+
+    # reads the body while the file is parsed, at most DOWNLOAD_BUFFER_CHUNKS ahead of the parser,
+    # so the connection is never left idle waiting for a parse thread
+    def _download(self, job: _FileJob, parsers: ThreadPoolExecutor) -> None:
+        try:
+            logger.info(f"Processing file: {job.key}")
+            stream = self.s3connector.get_file_stream(job.key)
+            if stream is None:
+                raise Exception("no response body")
+        except Exception as e:
+            logger.error(f"Failed to get file {job.key}: {e}")
+            job.failed = True
+            files_failed.inc()
+            self.in_flight.release()
+            return
+        parsers.submit(self._parse, job)
+        try:
+            for chunk in stream.iter_chunks(STREAM_CHUNK_SIZE):
+                if job.cancelled:
+                    break
+                # blocks while the parser is behind
+                job.chunks.put(chunk)
+            job.chunks.put(None)
+        except Exception as e:
+            job.chunks.put(e)
+        finally:
+            stream.close()
+
+    def _chunks(self, job: _FileJob):
+        while True:
+            chunk = job.chunks.get()
+            if chunk is None or isinstance(chunk, Exception):
+                job.read = True
+                if chunk is not None:
+                    raise chunk
+                return
+            yield chunk
+
+    def _parse(self, job: _FileJob) -> None:
+        try:
+            # the body is decoded and parsed as it arrives, batches are queued for writing chunk by chunk
+            lines = iterDecodedLines(self._chunks(job))
+            if self.parser_pool is not None:
+                batches = self._encodeInPool(job, lines)
+            else:
+                # read per file, files completed earlier in this run already moved the marks
+                high_water_marks = LatestValueStore().high_water_marks() if SKIP_INGESTED_ROWS else None
+                batches = (
+                    (len(batch), batch)
+                    for batch in iterLineProtocolBatches(lines, self.enabled_data_points, self.disabled_data_points, self.discovered_data_points,
+                                                         batch_size=INFLUX_BATCH_SIZE, written_data_points=job.data_points, high_water_marks=high_water_marks,
+                                                         row_counts=job.row_counts, enabled_ids=self.enabled_ids)
+                )
+            blocked = 0.0
+            start = time.perf_counter()
+            for points, batch in batches:
+                with job.lock:
+                    job.pending += 1
+                    job.points += points
+                waiting = time.perf_counter()
+                # blocks when writers fall behind
+                self.write_queue.put((job, batch))
+                blocked += time.perf_counter() - waiting
+                write_queue_depth.set(self.write_queue.qsize())
+            job.parse_seconds = time.perf_counter() - start - blocked
+        except Exception as e:
+            logger.error(f"Failed to parse file {job.key}: {e}")
+            job.failed = True
+        finally:
+            if not job.read:
+                # stop the download and take what it already buffered, so it never blocks on a full buffer
+                job.cancelled = True
+                while not job.read:
+                    chunk = job.chunks.get()
+                    job.read = chunk is None or isinstance(chunk, Exception)
+            self.in_flight.release()
+            with job.lock:
+                job.parsed = True
+            self._completeIfDone(job)
+
+    def _encodeInPool(self, job: _FileJob, lines):
+        for chunk in iterCsvChunks(lines):
+            batches, data_points, row_counts = self.parser_pool.encode("\n".join(chunk).encode('utf-8'), self.discovered_data_points, INFLUX_BATCH_SIZE)
+            mergeLatest(job.data_points, data_points)
+            addRowCounts(job.row_counts, row_counts)
+            yield from batches
+
+    def _writer(self) -> None:
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            job, batch = item
+            start = time.perf_counter()
+            try:
+                # returns once the batch is written to InfluxDB or spilled to the local queue
+                if not self.writer.write(batch):
+                    job.spilled = True
+            except Exception as e:
+                logger.error(f"Failed to write batch of {job.key}: {e}")
+                job.failed = True
+            finally:
+                with job.lock:
+                    job.write_seconds += time.perf_counter() - start
+                    job.pending -= 1
+                self._completeIfDone(job)
+
+    def _completeIfDone(self, job: _FileJob) -> None:
+        with job.lock:
+            if job.done or not job.parsed or job.pending > 0:
+                return
+            job.done = True
+        self._observe(job)
+        # cached query results of these fields are stale now, even if only part of the file was written
+        QueryCache().invalidate(job.data_points)
+        if job.failed or job.spilled:
+            LatestValueStore().invalidate(job.data_points)
+        if job.failed:
+            logger.error(f"File {job.key} was not fully written, leaving it unprocessed")
+            return
+        if job.spilled:
+            # the high-water marks only pass points InfluxDB acknowledged, a spilled batch may still be rejected
+            logger.warning(f"File {job.key} was partly spilled, its latest values are not recorded")
+        else:
+            LatestValueStore().update(job.data_points)
+        self.tag_queue.put(job)
+
+    # once per file, the hot loops only add to the job
+    def _observe(self, job: _FileJob) -> None:
+        rows_parsed.inc(job.row_counts.get("parsed", 0))
+        rows_skipped.inc(job.row_counts.get("skipped", 0))
+        rows_ingested.inc(job.row_counts.get("ingested", 0))
+        points_queued.inc(job.points)
+        if job.failed:
+            files_failed.inc()
+            return
+        files_processed.inc()
+        file_parse_seconds.observe(job.parse_seconds)
+        file_write_seconds.observe(job.write_seconds)
+        file_seconds.observe(time.perf_counter() - job.started)
+        logger.debug(f"File {job.key}: {job.row_counts}, parsed in {job.parse_seconds:.3f}s, written in {job.write_seconds:.3f}s")
+
+    def _tagger(self) -> None:
+        while True:
+            job = self.tag_queue.get()
+            if job is None:
+                return
+            logger.info(f"Marking file as processed: {job.key} ({job.points} points)")
+            self.s3connector.mark_file_as_processed(job.key)
+            self.processed += 1
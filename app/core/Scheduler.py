@@ -1,17 +1,22 @@
 import threading
 import time
 import os
-from typing import Optional
+from typing import Iterable, Optional
 import logging
 
 from app.core.dataProcessing import dataProcessing
+from app.tools import metrics
 
 
 logger = logging.getLogger(__name__)
 PROCESSING_DELAY = os.getenv('PROCESSING_DELAY', 3600)  # Default to 1 hour if not set
+# notifications arriving within this many seconds of each other are handled by one run
+PROCESSING_COALESCE_DELAY = float(os.getenv('PROCESSING_COALESCE_DELAY', 1))
 #
 
-# Singleton class to schedule data processing
+# Singleton class to schedule data processing.
+# One thread runs dataProcessing() every PROCESSING_DELAY seconds and whenever it is woken up by process_on_demand().
+# Requests made while a run is in progress are merged into a single follow-up run.
 class Scheduler:
     _instance: Optional['Scheduler'] = None
     _lock = threading.Lock()
@@ -20,32 +25,52 @@ class Scheduler:
         if not cls._instance:
             cls._instance = super(Scheduler, cls).__new__(cls, *args, **kwargs)
         return cls._instance
-    
-        
+
+
     def __init__(self) -> None:
         if not hasattr(self, 'initialized'):
             self.thread = None
             self.stop_event = threading.Event()
+            self.wake_event = threading.Event()
             self.delay = int(PROCESSING_DELAY)  # Default to 1 hour if not set
+            self.coalesce_delay = PROCESSING_COALESCE_DELAY
+            # pending work: a full run, or only the listed keys
+            self._pending_lock = threading.Lock()
+            self._pending_full = False
+            self._pending_keys = set()
+            self.running = False
             self.initialized = True
 
     def _process(self) -> None:
         logger.debug("Spawned processing thread: "+ str(threading.get_ident()))
         # wait 1 seconds before starting
-        time.sleep(1)
-        elapsed = self.delay
+        next_run = time.monotonic() + 1
         while not self.stop_event.is_set():
-            if elapsed >= self.delay:
-                try:
-                    dataProcessing()
-                    logger.info("Sleeping for " + str(self.delay) + " seconds")
-                except Exception as e:
-                    logger.error(f"Error processing data: {e}")
-                elapsed = 0
-            # else:
-                # logger.info(str(threading.get_ident())  + " Sleeping for " + str(self.delay - elapsed) + " seconds")
-            time.sleep(1)
-            elapsed += 1
+            woken = self.wake_event.wait(timeout=max(0.0, next_run - time.monotonic()))
+            if self.stop_event.is_set():
+                break
+            if woken:
+                # let a burst of notifications settle into one run
+                if self.stop_event.wait(self.coalesce_delay):
+                    break
+            with self._pending_lock:
+                self.wake_event.clear()
+                full = self._pending_full or time.monotonic() >= next_run
+                keys = self._pending_keys
+                self._pending_full = False
+                self._pending_keys = set()
+            if not full and not keys:
+                continue
+            self.running = True
+            try:
+                dataProcessing(None if full else keys)
+            except Exception as e:
+                logger.error(f"Error processing data: {e}")
+            finally:
+                self.running = False
+            if full:
+                next_run = time.monotonic() + self.delay
+                logger.info("Sleeping for " + str(self.delay) + " seconds")
         # close
         # logger.info("Processing thread stopped")
 
@@ -53,7 +78,7 @@ class Scheduler:
         with self._lock:
             if self.thread is None or not self.thread.is_alive():
                 self.stop_event.clear()
-                self.thread = threading.Thread(target=self._process)
+                self.thread = threading.Thread(target=self._process, name="scheduler")
                 self.thread.start()
             else:
                 logger.info("Data processing thread is already running, skipping start")
@@ -63,22 +88,31 @@ class Scheduler:
         with self._lock:
             if self.thread is not None and self.thread.is_alive():
                 self.stop_event.set()
+                self.wake_event.set()
                 self.thread.join()
                 self.thread = None
             else:
                 logger.info("Data processing thread is not running, skipping stop")
         return
 
-    def process_on_demand(self) -> None:
-        logger.info("Processing data on demand")
-        self.stop()
-        self.start()
-           
-    
-            
+    # never blocks: records the request and wakes the processing thread;
+    # keys limits the run to the given objects, None processes every unprocessed file
+    def process_on_demand(self, keys: Optional[Iterable[str]] = None) -> None:
+        with self._pending_lock:
+            if keys is None:
+                self._pending_full = True
+            else:
+                self._pending_keys.update(keys)
+            pending = "all files" if self._pending_full else f"{len(self._pending_keys)} files"
+        logger.info(f"Processing data on demand ({pending}{', after the current run' if self.running else ''})")
+        self.wake_event.set()
+
+
+metrics.callback_gauge("processing_running", "1 while a processing run is in progress", lambda: int(Scheduler().running))
+
 
 # Usage example:
 # processor = Scheduler()
 # processor.start_processing()
 # processor.process_on_demand()
-# processor.stop_processing()
\ No newline at end of file
+# processor.stop_processing()
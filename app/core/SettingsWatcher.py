@@ -0,0 +1,65 @@
+import os
+import threading
+from typing import Optional
+import logging
+
+from watchfiles import watch
+
+from app.core.registrationHandler import registerChangedItems
+from app.tools.Settings import SETTINGS_FILE, Settings
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_WATCH: bool = os.getenv('SETTINGS_WATCH', 'True').lower() == 'true'
+
+
+# Singleton thread watching SETTINGS_FILE: reloads the settings on change and re-registers changed items.
+# Readers keep using the previous settings until the new ones are loaded and validated,
+# the next processing run picks up the new data point tables (and restarts the parser pool).
+class SettingsWatcher:
+    _instance: Optional['SettingsWatcher'] = None
+    _lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs) -> 'SettingsWatcher':
+        if not cls._instance:
+            cls._instance = super(SettingsWatcher, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.thread = None
+            self.stop_event = threading.Event()
+            self.path = os.path.abspath(SETTINGS_FILE) if SETTINGS_FILE else None
+            self.initialized = True
+
+    def _watch(self) -> None:
+        # the directory is watched, editors and config maps replace the file instead of writing to it
+        directory = os.path.dirname(self.path)
+        for changes in watch(directory, watch_filter=self._isSettingsFile, stop_event=self.stop_event):
+            logger.info(f"Settings file {self.path} changed")
+            try:
+                reloaded = Settings().reload()
+                if reloaded is not None:
+                    registerChangedItems(*reloaded)
+            except Exception as e:
+                logger.error(f"Error reloading settings: {e}")
+
+    def _isSettingsFile(self, change, path: str) -> bool:
+        return os.path.abspath(path) == self.path
+
+    def start(self) -> None:
+        if not SETTINGS_WATCH or self.path is None:
+            return
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self._watch, name="settings-watcher", daemon=True)
+                self.thread.start()
+                logger.info(f"Watching settings file {self.path}")
+
+    def stop(self) -> None:
+        with self._lock:
+            if self.thread is not None and self.thread.is_alive():
+                self.stop_event.set()
+                self.thread.join()
+                self.thread = None
@@ -0,0 +1,262 @@
+import asyncio
+import codecs
+import csv
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+import logging
+
+from app.tools import metrics
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+UPLOAD_QUEUE_CHUNKS = int(os.getenv('UPLOAD_QUEUE_CHUNKS', 16))  # received chunks buffered per upload
+UPLOAD_SPOOL_SIZE = int(os.getenv('UPLOAD_SPOOL_SIZE', 16 * 1024 * 1024))  # raw bytes kept in memory before spilling to disk
+UPLOAD_JOBS_KEPT = int(os.getenv('UPLOAD_JOBS_KEPT', 1000))
+# tried in order, the first one that decodes the whole file wins
+UPLOAD_ENCODINGS = ("utf-8", "Windows-1250")
+SPOOL_READ_SIZE = 1024 * 1024
+INGEST_BLOCK_LINES = 10000  # lines handed to the direct ingest at once
+
+_CANCEL = object()  # ends the direct ingest without using its result
+
+
+# One uploaded csv file: chunks received by the handler are transcoded to utf-8 and written to S3 by a worker thread.
+# The raw bytes are spooled, so the file can be transcoded again with the fallback encoding or moved to the error bucket.
+class UploadJob:
+    def __init__(self, file_name: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.status = "receiving"
+        self.encoding = None
+        self.bytes = 0
+        self.rows = None
+        self.error = None
+        self.created = time.time()
+        self.points = None
+        # received chunks; the handler takes a slot per chunk and the worker gives it back, the end marker needs none
+        self.queue = queue.Queue()
+        self.slots = asyncio.Semaphore(max(1, UPLOAD_QUEUE_CHUNKS))
+        self._loop = None
+        self._ended = False
+        self.spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        self._received = False
+        self.ingest_queue = queue.Queue(maxsize=UPLOAD_QUEUE_CHUNKS)
+        self._ingest_ended = False
+        self._ingest_read = False
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "file_name": self.file_name,
+            "status": self.status,
+            "encoding": self.encoding,
+            "bytes": self.bytes,
+            "rows": self.rows,
+            "points": self.points,
+            "error": self.error,
+        }
+
+    # called by the request handler, waits without holding a thread while the worker is behind
+    async def put(self, chunk: bytes) -> None:
+        self._loop = asyncio.get_running_loop()
+        await self.slots.acquire()
+        self.queue.put_nowait(chunk)
+
+    # None ends the file, an exception fails the job; never waits, so it is safe while the handler is cancelled
+    def end(self, marker: Optional[Exception] = None) -> None:
+        if not self._ended:
+            self._ended = True
+            self.queue.put_nowait(marker)
+
+    # called by the worker for every chunk it took
+    def _release(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self.slots.release)
+        except RuntimeError:
+            # the event loop is closed, no handler waits for a slot anymore
+            pass
+
+    # raw chunks: the spooled ones first (when transcoding again), then the ones still arriving
+    def _raw(self) -> Iterator[bytes]:
+        self.spool.seek(0)
+        while True:
+            chunk = self.spool.read(SPOOL_READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        while not self._received:
+            chunk = self.queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                self._received = True
+                if self.status == "receiving":
+                    self.status = "uploading"
+                if chunk is not None:
+                    raise chunk
+                break
+            self._release()
+            self.spool.write(chunk)
+            self.bytes += len(chunk)
+            yield chunk
+
+    # transcoded csv lines with line endings, raises UnicodeDecodeError when the file is not in this encoding
+    def lines(self, encoding: str, upload) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        partial = ""
+        for chunk in self._raw():
+            text = decoder.decode(chunk)
+            upload.write(text.encode('utf-8'))
+            lines = (partial + text).split('\n')
+            partial = lines.pop()
+            yield from (line + '\n' for line in lines)
+        text = decoder.decode(b"", final=True)
+        upload.write(text.encode('utf-8'))
+        partial += text
+        if partial:
+            yield partial
+
+    # keep reading so the handler never blocks on a full queue after a failure
+    def drain(self) -> None:
+        for _ in self._raw():
+            pass
+
+    # passes lines through, handing them to the direct ingest in blocks
+    def feedIngest(self, lines: Iterator[str]) -> Iterator[str]:
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) >= INGEST_BLOCK_LINES:
+                self.ingest_queue.put(block)
+                block = []
+            yield line
+        if block:
+            self.ingest_queue.put(block)
+
+    def endIngest(self, cancel: bool = False) -> None:
+        if not self._ingest_ended:
+            self._ingest_ended = True
+            self.ingest_queue.put(_CANCEL if cancel else None)
+
+    # lines for the ingest thread, raises when the ingest is cancelled
+    def ingestLines(self) -> Iterator[str]:
+        while True:
+            block = self.ingest_queue.get()
+            if block is None or block is _CANCEL:
+                self._ingest_read = True
+                if block is _CANCEL:
+                    raise Exception("direct ingest cancelled")
+                return
+            yield from block
+
+    # after an ingest failure, read until the end so feedIngest never blocks
+    def drainIngest(self) -> None:
+        while not self._ingest_read:
+            block = self.ingest_queue.get()
+            self._ingest_read = block is None or block is _CANCEL
+
+
+# Singleton that runs upload jobs off the event loop and keeps their status for the status endpoint
+class UploadManager:
+    _instance: Optional['UploadManager'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'UploadManager':
+        if not cls._instance:
+            cls._instance = super(UploadManager, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.executor = ThreadPoolExecutor(UPLOAD_CONCURRENCY, thread_name_prefix="csv-upload")
+            self.ingest_executor = ThreadPoolExecutor(UPLOAD_CONCURRENCY, thread_name_prefix="csv-upload-ingest")
+            self._lock = threading.Lock()
+            self.jobs: 'OrderedDict[str, UploadJob]' = OrderedDict()
+            self.initialized = True
+
+    # s3connector stores the file, on_uploaded(job) runs once it is stored;
+    # with ingest(lines) -> (latest points, number of points) the file is written to InfluxDB while it is stored,
+    # then on_ingested(job, latest) runs instead of on_uploaded
+    def start(self, file_name: str, s3connector, on_uploaded, ingest=None, on_ingested=None) -> UploadJob:
+        job = UploadJob(file_name)
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > UPLOAD_JOBS_KEPT:
+                self.jobs.popitem(last=False)
+        self.executor.submit(self._run, job, s3connector, on_uploaded, ingest, on_ingested)
+        return job
+
+    def get(self, job_id: str) -> Optional[UploadJob]:
+        return self.jobs.get(job_id)
+
+    def _ingest(self, job: UploadJob, ingest):
+        try:
+            return ingest(job.ingestLines())
+        except Exception:
+            job.drainIngest()
+            raise
+
+    def _run(self, job: UploadJob, s3connector, on_uploaded, ingest, on_ingested) -> None:
+        upload = s3connector.open_upload(job.file_name)
+        ingesting = self.ingest_executor.submit(self._ingest, job, ingest) if ingest is not None else None
+        try:
+            for encoding in UPLOAD_ENCODINGS:
+                try:
+                    lines = job.lines(encoding, upload)
+                    if ingesting is not None and not job._ingest_ended:
+                        lines = job.feedIngest(lines)
+                    job.rows = sum(1 for _ in csv.reader(lines))
+                    job.encoding = encoding
+                    break
+                except UnicodeDecodeError:
+                    if encoding == UPLOAD_ENCODINGS[-1]:
+                        raise
+                    # parts written so far are dropped, the spooled file is transcoded again
+                    logger.info(f"File {job.file_name} is not {encoding}, transcoding it again")
+                    upload.abort()
+                    # points may have been decoded wrongly, the file is left to the processing run
+                    job.endIngest(cancel=True)
+            # the ingest ends only once the file is stored, a failed upload still cancels it
+            upload.complete()
+            job.endIngest()
+        except Exception as e:
+            logger.error(f"Error processing CSV file {job.file_name}: {e}")
+            job.endIngest(cancel=True)
+            upload.abort()
+            job.status = "failed"
+            job.error = str(e)
+            try:
+                job.drain()
+                # push to error bucket
+                job.spool.seek(0)
+                s3connector.push_to_storage_error(job.spool, job.file_name)
+            except Exception as e:
+                logger.error(f"Error pushing file to error bucket: {e}")
+            return
+        finally:
+            job.spool.close()
+        logger.debug(f"Uploaded file {job.file_name} with size {job.bytes} bytes and {job.rows} rows")
+        job.status = "uploaded"
+        try:
+            if ingesting is not None:
+                try:
+                    latest, job.points = ingesting.result()
+                except Exception as e:
+                    logger.error(f"Direct ingest of {job.file_name} did not complete, leaving it to the processing run: {e}")
+                else:
+                    on_ingested(job, latest)
+                    job.status = "ingested"
+                    logger.info(f"Ingested uploaded file {job.file_name} ({job.points} points)")
+                    return
+            on_uploaded(job)
+        except Exception as e:
+            logger.error(f"Error after uploading CSV file {job.file_name}: {e}")
+
+
+metrics.callback_gauge("upload_jobs_active", "CSV uploads still being received or stored",
+                       lambda: sum(1 for job in list(UploadManager().jobs.values()) if job.status in ("receiving", "uploading")))
@@ -0,0 +1,245 @@
+import codecs
+import csv
+import itertools
+import logging
+import os
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from app.tools.LatestValueStore import mergeLatest
+from app.tools.TimestampConverter import TimestampConverter
+
+logger = logging.getLogger(__name__)
+
+MEASUREMENT = "koor_processed_data"
+DEFAULT_BATCH_SIZE = 5000  # the ingest passes INFLUX_BATCH_SIZE of the writer
+# rows parsed at once, bounds memory used per file
+PARSE_CHUNK_ROWS = int(os.getenv('PARSE_CHUNK_ROWS', 100000))
+CSV_COLUMNS = ['KOD_OBJEKTU', 'KOD_MERACA', 'NAZOV_MERACA', 'UID', 'ENERGIA', 'PM_TIME', 'POCITADLO']
+
+# same escaping rules as influxdb_client.Point, so the produced line protocol is identical
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_TAG_SEPARATOR = '\x1f'
+_NO_MARK = np.iinfo(np.int64).min
+_LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+
+def _escapeTagValue(value: str) -> str:
+    escaped = value.translate(_ESCAPE_KEY)
+    if escaped.endswith('\\'):
+        escaped += ' '
+    return escaped
+
+
+def _tagSet(energy: str, meter_name: str, object_code: str) -> str:
+    # tags are sorted by key and empty values are dropped, like Point does
+    tags = []
+    for key, value in (("energy", energy), ("meter_name", meter_name), ("object_code", object_code)):
+        value = _escapeTagValue(value)
+        if value != '':
+            tags.append(f"{key}={value}")
+    measurement = MEASUREMENT.translate(_ESCAPE_MEASUREMENT)
+    return f"{measurement}{',' if tags else ''}{','.join(tags)} "
+
+
+def _formatFloat(value: float) -> str:
+    s = str(value)
+    if s.endswith('.0'):
+        s = s[:-2]
+    return s
+
+
+# decode byte chunks incrementally and yield lines without line endings, like str.splitlines() on the whole text
+def iterDecodedLines(chunks: Iterable[bytes], encoding: str = 'utf-8') -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        text = pending + decoder.decode(chunk)
+        # a \r\n split between chunks is one line break, keep the \r until the next chunk
+        carriage_return = text.endswith('\r')
+        if carriage_return:
+            text = text[:-1]
+        lines = text.splitlines()
+        # the last line continues in the next chunk unless the text ends with a line break
+        pending = lines.pop() if text and text[-1] not in _LINE_BREAKS else ''
+        if carriage_return:
+            pending += '\r'
+        yield from lines
+    text = pending + decoder.decode(b'', final=True)
+    yield from text.splitlines()
+
+
+# split csv lines into chunks of at most chunk_rows records, each chunk starts with the header;
+# chunks are cut between records, so a quoted field spanning several lines stays in one chunk
+def iterCsvChunks(lines: Iterable[str], chunk_rows: int = PARSE_CHUNK_ROWS) -> Iterator[List[str]]:
+    # the reader pulls lines only until its record is complete, consumed then holds exactly the lines of that record
+    consumed = []
+
+    def consume():
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    reader = csv.reader(consume(), delimiter=';')
+    if next(reader, None) is None:
+        return
+    header = consumed
+    while True:
+        consumed = []
+        records = sum(1 for _ in itertools.islice(reader, chunk_rows))
+        if records == 0:
+            return
+        yield header + consumed
+
+
+def _columnIndex(header: List[str]) -> dict:
+    # later duplicates win, same as csv.DictReader
+    index = {name: i for i, name in enumerate(header)}
+    missing = [name for name in CSV_COLUMNS if name not in index]
+    if missing:
+        raise ValueError(f"CSV is missing columns: {missing}")
+    return index
+
+
+# read csv rows into numpy string columns (one array per column in CSV_COLUMNS)
+def _rowsToColumns(rows: List[List[str]], index: dict) -> dict:
+    columns = {}
+    for name in CSV_COLUMNS:
+        i = index[name]
+        columns[name] = np.array([r[i] for r in rows], dtype=str)
+    return columns
+
+
+# add row counts of one chunk to target: parsed, skipped (not enabled or not a number), ingested (behind the high-water mark)
+def addRowCounts(target: dict, counts: dict) -> None:
+    for key, count in counts.items():
+        target[key] = target.get(key, 0) + count
+
+
+# convert parsed columns to line protocol, skipping data points that are not enabled
+# written_data_points, when given, collects {id: (timestamp ns, value)} of the latest encoded point of each id
+# high_water_marks, when given, skips rows not newer than {id: timestamp ns} of the last ingested point of their id
+# row_counts, when given, collects the counts of addRowCounts
+# enabled_ids is the id array of Settings().get_enabled_ids(), built from enabled_data_points when not given
+# discovered_names, when given, collects {id: meter name} of data points that are not enabled instead of logging them
+def encodeColumns(columns: dict, enabled_data_points: dict, disabled_data_points, discovered_data_points: set,
+                  written_data_points: Optional[dict] = None, high_water_marks: Optional[dict] = None,
+                  row_counts: Optional[dict] = None, enabled_ids: Optional[np.ndarray] = None,
+                  discovered_names: Optional[dict] = None) -> List[str]:
+    object_codes = columns['KOD_OBJEKTU']
+    if len(object_codes) == 0:
+        return []
+    counts = {"parsed": len(object_codes), "skipped": 0, "ingested": 0}
+    if row_counts is not None:
+        # filled in place as rows are dropped, so early returns are counted too
+        addRowCounts(row_counts, counts)
+        counts = row_counts
+    ids = np.char.add(np.char.add(np.char.add(np.char.add(object_codes, "_"), columns['KOD_MERACA']), "_"), columns['UID'])
+
+    # vectorized membership test against enabled data points
+    if enabled_ids is None:
+        enabled_ids = np.array(list(enabled_data_points.keys()), dtype=str)
+    mask = np.isin(ids, enabled_ids)
+    if not mask.all():
+        rejected, first = np.unique(ids[~mask], return_index=True)
+        meter_names = columns['NAZOV_MERACA'][~mask][first]
+        discovered = {
+            id: meter_name for id, meter_name in zip(rejected.tolist(), meter_names.tolist())
+            if id not in disabled_data_points and id not in discovered_data_points
+        }
+        if discovered_names is not None:
+            discovered_names.update(discovered)
+            discovered_data_points.update(discovered)
+        else:
+            logDiscovered(discovered, discovered_data_points)
+        counts["skipped"] += int((~mask).sum())
+        if not mask.any():
+            return []
+        ids = ids[mask]
+
+    values = columns['POCITADLO'][mask].astype(np.float64)
+    # Point drops non-finite fields, which leaves nothing to write for the row
+    finite = np.isfinite(values)
+    if not finite.all():
+        counts["skipped"] += int((~finite).sum())
+        mask = mask.copy()
+        mask[mask] = finite
+        ids = ids[finite]
+        values = values[finite]
+
+    # each distinct timestamp, id and tag set is converted only once
+    converter = TimestampConverter()
+    times, time_inverse = np.unique(columns['PM_TIME'][mask], return_inverse=True)
+    timestamps = np.array([converter.toUtcNanoseconds(t) for t in times.tolist()], dtype=np.int64)[time_inverse.ravel()]
+
+    if high_water_marks:
+        # overlapping exports repeat rows that were already written, drop them before anything is encoded
+        fields, field_inverse = np.unique(ids, return_inverse=True)
+        marks = np.array([high_water_marks.get(f, _NO_MARK) for f in fields.tolist()], dtype=np.int64)
+        fresh = timestamps > marks[field_inverse.ravel()]
+        if not fresh.all():
+            counts["ingested"] += int((~fresh).sum())
+            if not fresh.any():
+                return []
+            mask = mask.copy()
+            mask[mask] = fresh
+            ids = ids[fresh]
+            values = values[fresh]
+            timestamps = timestamps[fresh]
+
+    fields, field_inverse = np.unique(ids, return_inverse=True)
+    field_inverse = field_inverse.ravel()
+    if written_data_points is not None:
+        # last row of each id after sorting by id, then timestamp
+        order = np.lexsort((timestamps, field_inverse))
+        last = order[np.append(np.flatnonzero(np.diff(field_inverse[order])), len(order) - 1)]
+        mergeLatest(written_data_points, dict(zip(fields.tolist(), zip(timestamps[last].tolist(), values[last].tolist()))))
+    field_keys = np.array([f.translate(_ESCAPE_KEY) + "=" for f in fields.tolist()], dtype=object)[field_inverse]
+
+    tag_keys = np.char.add(np.char.add(np.char.add(np.char.add(
+        columns['ENERGIA'][mask], _TAG_SEPARATOR), columns['NAZOV_MERACA'][mask]), _TAG_SEPARATOR), columns['KOD_OBJEKTU'][mask])
+    _, tag_first, tag_inverse = np.unique(tag_keys, return_index=True, return_inverse=True)
+    tag_sets = np.array([
+        _tagSet(energy, meter_name, object_code) for energy, meter_name, object_code in zip(
+            columns['ENERGIA'][mask][tag_first].tolist(),
+            columns['NAZOV_MERACA'][mask][tag_first].tolist(),
+            columns['KOD_OBJEKTU'][mask][tag_first].tolist())
+    ], dtype=object)[tag_inverse.ravel()]
+
+    return [
+        tag_set + field_key + _formatFloat(value) + " " + str(timestamp)
+        for tag_set, field_key, value, timestamp
+        in zip(tag_sets.tolist(), field_keys.tolist(), values.tolist(), timestamps.tolist())
+    ]
+
+
+# log {id: meter name} of data points that are not enabled, each id once per set of discovered_data_points
+def logDiscovered(discovered_names: dict, discovered_data_points: set) -> None:
+    for id, meter_name in discovered_names.items():
+        if id not in discovered_data_points:
+            logger.info(f"Data point {meter_name} [{id}] is not enabled, skipping")
+            discovered_data_points.add(id)
+
+
+# parse csv lines chunk by chunk and yield line protocol in batches of at most batch_size points
+def iterLineProtocolBatches(lines: Iterable[str], enabled_data_points: dict, disabled_data_points, discovered_data_points: set,
+                            batch_size: int = DEFAULT_BATCH_SIZE, chunk_rows: int = PARSE_CHUNK_ROWS,
+                            written_data_points: Optional[dict] = None, high_water_marks: Optional[dict] = None,
+                            row_counts: Optional[dict] = None, enabled_ids: Optional[np.ndarray] = None,
+                            discovered_names: Optional[dict] = None) -> Iterator[List[str]]:
+    reader = csv.reader(lines, delimiter=';')
+    header = next(reader, None)
+    if header is None:
+        return
+    index = _columnIndex(header)
+    while True:
+        chunk = list(itertools.islice(reader, chunk_rows))
+        if not chunk:
+            return
+        columns = _rowsToColumns([r for r in chunk if r], index)
+        encoded = encodeColumns(columns, enabled_data_points, disabled_data_points, discovered_data_points, written_data_points,
+                                high_water_marks, row_counts, enabled_ids, discovered_names)
+        for start in range(0, len(encoded), batch_size):
+            yield encoded[start:start + batch_size]
@@ -1,86 +1,117 @@
 
-import csv
-import io
+
 import logging
+import os
+import time
+from typing import Collection, Iterable, Optional, Tuple
 
-import pytz
-from datetime import datetime
 from app.tools.Settings import Settings
-from influxdb_client import Point
+from app.core.ProcessingPipeline import (
+    FILE_BUCKETS, SKIP_INGESTED_ROWS, ProcessingPipeline, points_queued, rows_ingested, rows_parsed, rows_skipped,
+)
+from app.core.ParserPool import ParserPool
+from app.core.csvIngest import iterLineProtocolBatches
+from app.tools import metrics
+from app.tools.QueryCache import QueryCache
+from app.tools.TimestampConverter import TimestampConverter
 
 logger = logging.getLogger(__name__)
 
 from app.microservicies.ObjectStorageConnector import ObjectStorageConnector
+from app.microservicies.InfluxWriter import INFLUX_BATCH_SIZE, InfluxWriter
 from app.microservicies.InfluxConnector import InfluxConnector
+from app.tools.LatestValueStore import LatestValueStore
 
-influxconnector = InfluxConnector()
+influxwriter = InfluxWriter()
 s3connector = ObjectStorageConnector()
 settings = Settings()
 
+LATEST_WARMUP_BATCH = 500  # fields per last() query when warming the latest values
+# uploaded files are written to InfluxDB while they are stored, instead of by the next processing run
+DIRECT_UPLOAD_INGEST = os.getenv('DIRECT_UPLOAD_INGEST', 'False').lower() == 'true'
+
+run_seconds = metrics.histogram("processing_run_seconds", "Duration of processing runs", FILE_BUCKETS + (3600.0,))
+last_run = metrics.gauge("processing_last_run_timestamp_seconds", "Unix time the last processing run finished")
+
 
 # list unprocessed csv files from s3, process them (push to influxdb), mark as processed in s3 (tag)
-def dataProcessing():
+# keys limits the run to the given objects instead of listing the bucket
+def dataProcessing(keys: Optional[Collection[str]] = None):
+    start = time.perf_counter()
     try:
-        logger.info("Processing data")
+        logger.info("Processing data" if keys is None else f"Processing data of {len(keys)} notified files")
+        # batches spilled during an earlier InfluxDB outage go first
+        influxwriter.replay_spilled()
         # List unprocessed files from S3
-        unprocessed_files = s3connector.list_unprocessed_files()
-        logger.info(f"There are {len(unprocessed_files)} unprocessed files")
-        enabled_data_points = settings.get_enabled_data_points()
-        disabled_data_points = settings.get_disabled_data_points()
-        this_run_discovered_data_points = []
-        for file in unprocessed_files:
-            logger.info(f"Processing file: {file}")
-            # Process file
-            data = s3connector.get_file(file)
-            if not data:
-                logger.error(f"Failed to get file {file}")
-                return
-            # parse csv file
-            #convert binary to string
-            # set delimiter to
-            dataString = data.getvalue().decode('utf-8').splitlines()
-            measurements = csv.DictReader(dataString, delimiter=';')
-            data_points = []
+        if keys is None:
+            unprocessed_files = s3connector.list_unprocessed_files()
+        else:
+            unprocessed_files = s3connector.filter_unprocessed(sorted(keys))
+        pipeline = ProcessingPipeline(s3connector, influxwriter, parser_pool=ParserPool())
+        processed = pipeline.run(unprocessed_files, settings.index)
+        logger.info(f"Marked {processed} of {pipeline.files} unprocessed files as processed")
+        s3connector.advance_listing_watermark()
+        if pipeline.parser_pool is not None:
+            logger.info(f"Timestamp cache of the parser processes: {pipeline.parser_pool.timestamp_stats()}")
+        else:
+            logger.info(f"Timestamp cache: {TimestampConverter().stats()}")
+        logger.info("Data processing complete")
+    except Exception as e:
+        logger.error(f"Error processing data: {e}")
+    finally:
+        run_seconds.observe(time.perf_counter() - start)
+        last_run.set(time.time())
 
-            for m in measurements:
-                object_code=m['KOD_OBJEKTU']
-                meter_code=m['KOD_MERACA']
-                value=float(m['POCITADLO'])
-                meter_name= m['NAZOV_MERACA']
-                uid=m['UID']
-                energia=m['ENERGIA']
-                timestamp_csv=m['PM_TIME']
-                local_timezone = pytz.timezone("Europe/Bratislava")  
-                timestamp_local = datetime.strptime(timestamp_csv, "%d.%m.%Y %H:%M")
-                timestamp_utc = local_timezone.localize(timestamp_local).astimezone(pytz.utc)
-                id = object_code + "_" + meter_code + "_" + uid
+# parse csv lines of an uploaded file and write them to InfluxDB, returns ({id: latest point}, number of points)
+def ingestLines(lines: Iterable[str]) -> Tuple[dict, int]:
+    # one snapshot, a reload while the file is ingested does not mix tables of two versions
+    index = settings.index
+    high_water_marks = LatestValueStore().high_water_marks() if SKIP_INGESTED_ROWS else None
+    latest = {}
+    row_counts = {}
+    points = 0
+    spilled = False
+    try:
+        for batch in iterLineProtocolBatches(lines, index.enabled_data_points, index.disabled_data_points, set(), batch_size=INFLUX_BATCH_SIZE,
+                                             written_data_points=latest, high_water_marks=high_water_marks, row_counts=row_counts,
+                                             enabled_ids=index.enabled_ids):
+            # returns once the batch is written to InfluxDB or spilled to the local queue
+            if not influxwriter.write(batch):
+                spilled = True
+            points += len(batch)
+    except Exception:
+        # batches written before the ingest failed or was cancelled are in InfluxDB, cached results of their fields are stale
+        QueryCache().invalidate(latest)
+        LatestValueStore().invalidate(latest)
+        raise
+    finally:
+        rows_parsed.inc(row_counts.get("parsed", 0))
+        rows_skipped.inc(row_counts.get("skipped", 0))
+        rows_ingested.inc(row_counts.get("ingested", 0))
+        points_queued.inc(points)
+    if spilled:
+        # like the pipeline, latest values (the high-water marks) only pass points InfluxDB acknowledged
+        logger.warning("Uploaded file was partly spilled, its latest values are not recorded")
+        QueryCache().invalidate(latest)
+        LatestValueStore().invalidate(latest)
+        return {}, points
+    return latest, points
 
-                # check if id is enabled
-                d = enabled_data_points.get(id)
-                if d is None:
-                    if id not in disabled_data_points and id not in this_run_discovered_data_points:
-                        logger.info(f"Data point {meter_name} [{id}] is not enabled, skipping")
-                        this_run_discovered_data_points.append(id)
-                        pass
-                    continue
 
-                # build influx format
-                point = (
-                    Point("koor_processed_data") 
-                    .tag("energy", energia)   
-                    .tag("meter_name", meter_name)
-                    .tag("object_code", object_code)
-                    .field(id, value)
-                    .time(timestamp_utc)          
-                )
-                # push to influx queue
-                data_points.append(point)            
+# same bookkeeping as the processing pipeline after a file is written: caches, latest values, processed tag
+def completeIngest(key: str, latest: dict) -> None:
+    QueryCache().invalidate(latest)
+    LatestValueStore().update(latest)
+    s3connector.mark_file_as_processed(key)
 
-            # Write all data points to InfluxDB
-            influxconnector.write_multiple_data(data_points)
-            # Mark file as processed
-            logger.info(f"Marking file as processed: {file}")
-            s3connector.mark_file_as_processed(file)
-        logger.info("Data processing complete")
+
+# fill the latest value table from InfluxDB, points written by the ingest since then are never overwritten
+def warmLatestValues():
+    try:
+        pids = list(settings.get_enabled_data_points().keys())
+        latestvalues = LatestValueStore()
+        for start in range(0, len(pids), LATEST_WARMUP_BATCH):
+            latestvalues.update(InfluxConnector().getLatest(pids[start:start + LATEST_WARMUP_BATCH]))
+        logger.info(f"Warmed latest values: {latestvalues.stats()}")
     except Exception as e:
-        logger.error(f"Error processing data: {e}")
\ No newline at end of file
+        logger.error(f"Error warming latest values: {e}")
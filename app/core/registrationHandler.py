@@ -2,45 +2,88 @@
 import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from app.microservicies.AuroralNode import AuroralNode
-from app.tools.Settings import Settings
+from app.tools.RegistrationCache import RegistrationCache, tdHash
+from app.tools.Settings import Settings, SettingsIndex
 
 logger = logging.getLogger(__name__)
 
 settings = Settings()
-itemsSettings = settings.get_items()
-enabled_data_points = settings.get_enabled_data_points()
 auroralNode = AuroralNode()
+registrationCache = RegistrationCache()
 
 adapter_host: str = os.getenv('ADAPTER_HOST')
+REGISTRATION_CONCURRENCY: int = int(os.getenv('REGISTRATION_CONCURRENCY', 8))
 
 def initRegistrationCheck():
-    for i in itemsSettings:
-        adapterid = i.get('adapterid')
+    _checkAll(settings.get_items())
+
+# items are checked concurrently, each one is a few blocking calls to the node
+def _checkAll(items: list):
+    if not items:
+        return
+    start = time.time()
+    with ThreadPoolExecutor(REGISTRATION_CONCURRENCY, thread_name_prefix="registration") as executor:
+        results = list(executor.map(checkRegistration, items))
+    logger.info(f"Registration check of {len(items)} items took {time.time()-start:.1f} seconds, "
+                f"{results.count('unchanged')} unchanged, {results.count('updated')} updated, "
+                f"{results.count('registered')} registered, {results.count('failed')} failed")
+
+# returns 'unchanged', 'updated', 'registered' or 'failed'
+def checkRegistration(i: dict) -> str:
+    adapterid = i.get('adapterid')
+    try:
+        tdJson = buildTd(i)
+        if tdJson is None:
+            return 'failed'
+        td_hash = tdHash(tdJson)
         # check if item is already registered
-        # logger.info(f"Checking registration for item {adapterid}")
         oid = auroralNode.getRegistartionOidByAdapterid(adapterid)
         if(oid):
+            if registrationCache.is_current(adapterid, oid, td_hash):
+                logger.info(f"Item {adapterid} is registered with OID {oid} and unchanged, skipping update")
+                return 'unchanged'
             logger.info(f"Item {adapterid} is already registered with OID {oid}")
-            updateItem(i, oid)
+            if not updateItem(i, oid, tdJson):
+                return 'failed'
+            registrationCache.put(adapterid, oid, td_hash)
+            return 'updated'
+        logger.info(f"Item {adapterid} is not registered")
+        # register item
+        if not registerItem(i, tdJson):
+            return 'failed'
+        registrationCache.put(adapterid, auroralNode.getRegistartionOidByAdapterid(adapterid), td_hash)
+        return 'registered'
+    except Exception as e:
+        logger.error(f"Error checking registration of item {adapterid}: {e}")
+        return 'failed'
+
+# everything buildTd reads for an item
+def _tdInputs(index: SettingsIndex, item: dict) -> tuple:
+    return item, [index.enabled_data_points.get(p) for p in item.get('properties') or []], index.td_template
+
+# after a settings reload, register or update only the items whose TD changed
+def registerChangedItems(old: SettingsIndex, new: SettingsIndex):
+    changed = []
+    for i in new.items:
+        adapterid = i.get('adapterid')
+        previous = old.items_by_adapterid.get(adapterid)
+        if previous is not None and _tdInputs(old, previous) == _tdInputs(new, i):
             continue
-        else:
-            logger.info(f"Item {adapterid} is not registered")
-            # register item
-            registerItem(i)
-            # logger.info(f"Item {adapterid} registered")
+        logger.info(f"Item {adapterid} changed in settings")
+        changed.append(i)
+    _checkAll(changed)
+    for adapterid in old.items_by_adapterid.keys() - new.items_by_adapterid.keys():
+        logger.warning(f"Item {adapterid} was removed from settings, it stays registered in the node")
 
 def buildTd(itemSettings: dict)-> json:
     adapterid = itemSettings.get('adapterid')
-    # load td from template file
-    tdJson = {}
-    try:
-        tdString = ""
-        with open('app/templates/td.json') as f:
-            tdString = f.read()
-            tdJson = json.loads(tdString)
-    except Exception as e:
-        logger.error(f"Error loading td file: {e}")
+    # copy of the td template parsed when the settings were loaded
+    tdJson = settings.get_td_template()
+    if tdJson is None:
+        logger.error("Error loading td file")
         return
     # fill in the template
     tdJson['adapterId'] = adapterid
@@ -50,7 +93,7 @@ def buildTd(itemSettings: dict)-> json:
     # prepare properties
     properties = {}
     for p in itemSettings.get('properties'):
-        details = enabled_data_points.get(p)
+        details = settings.get_data_point(p)
         if not details:
             logger.error("Inconsistency in settings file: property " + p + " not found in enabled_data_points")
             return
@@ -84,19 +127,21 @@ def buildTd(itemSettings: dict)-> json:
     tdJson['properties'] = properties
     return tdJson
 
-def registerItem(itemSettings: dict):
+def registerItem(itemSettings: dict, tdJson: dict = None) -> bool:
     adapterid = itemSettings.get('adapterid')
     # build td
-    tdJson = buildTd(itemSettings)
+    if tdJson is None:
+        tdJson = buildTd(itemSettings)
     # register item
-    auroralNode.registerItem({'td': tdJson})
+    if not auroralNode.registerItem({'td': tdJson}):
+        return False
     logger.info(f"Item {adapterid} registered")
+    return True
     
-def updateItem(itemSettings: dict, oid: str = None):
+def updateItem(itemSettings: dict, oid: str = None, tdJson: dict = None) -> bool:
     # build td
-    tdJson = buildTd(itemSettings)
-    tdJson['oid'] = oid
-    tdJson['id'] = oid
+    if tdJson is None:
+        tdJson = buildTd(itemSettings)
+    tdJson = dict(tdJson, oid=oid, id=oid)
     # update item
-    auroralNode.updateItem({'td': tdJson})
-    # logger.info(f"Item {itemSettings.get('adapterid')} updated")
\ No newline at end of file
+    return auroralNode.updateItem({'td': tdJson})
@@ -0,0 +1,167 @@
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+from influxdb_client.client.util.date_utils import get_date_helper
+
+# Compact encodings of property values built straight from the annotated CSV of a Flux query,
+# without FluxRecord objects, per-record dicts or jsonable_encoder.
+
+FORMATS = ("json", "columnar", "csv", "npy")
+STREAM_FORMATS = ("json", "csv")  # json is streamed as NDJSON
+MEDIA_TYPES = {
+    "columnar": "application/json",
+    "csv": "text/csv",
+    "npy": "application/octet-stream",
+}
+STREAM_MEDIA_TYPES = {
+    "json": "application/x-ndjson",
+    "csv": "text/csv",
+}
+# rows per chunk of a streamed response
+STREAM_FLUSH_ROWS = int(os.getenv('STREAM_FLUSH_ROWS', 1000))
+NPY_DTYPE = np.dtype([('timestamp', '<i8'), ('value', '<f8')])
+
+
+# Incremental reader of annotated CSV rows, returns (field, RFC3339 time, value as string) for data rows
+class AnnotatedCsvRows:
+    def __init__(self) -> None:
+        self.header = None
+        self.time_index = None
+        self.error_index = None
+
+    def read(self, row: List[str]) -> Optional[Tuple[str, str, str]]:
+        if not row or row[0].startswith('#'):
+            # annotations start a new table schema, the header follows
+            self.header = None
+            return None
+        if self.header is None:
+            self.header = row
+            self.time_index = self.error_index = None
+            if {'_time', '_value', '_field'}.issubset(row):
+                self.time_index, self.value_index, self.field_index = row.index('_time'), row.index('_value'), row.index('_field')
+            elif 'error' in row:
+                self.error_index = row.index('error')
+            # otherwise a table without values, its rows are skipped
+            return None
+        if self.error_index is not None:
+            raise Exception(f"InfluxDB query failed: {row[self.error_index]}")
+        if self.time_index is None:
+            return None
+        return row[self.field_index], row[self.time_index], row[self.value_index]
+
+
+# annotated CSV -> {field: (RFC3339 times, values as strings)}, keeping the order of the query
+def parseAnnotatedCsv(content: bytes) -> Dict[str, Tuple[List[str], List[str]]]:
+    columns: Dict[str, Tuple[List[str], List[str]]] = {}
+    reader = AnnotatedCsvRows()
+    for row in csv.reader(io.StringIO(content.decode('utf-8'))):
+        record = reader.read(row)
+        if record is None:
+            continue
+        times, values = columns.setdefault(record[0], ([], []))
+        times.append(record[1])
+        values.append(record[2])
+    return columns
+
+
+def _epochMilliseconds(times: List[str]) -> np.ndarray:
+    if not times:
+        return np.array([], dtype=np.int64)
+    # InfluxDB returns UTC with a Z suffix, numpy wants naive timestamps
+    return np.char.rstrip(np.array(times), 'Z').astype('datetime64[ns]').astype('datetime64[ms]').astype(np.int64)
+
+
+def _floatValues(values: List[str]) -> np.ndarray:
+    # empty cells are nulls
+    return np.array([v if v != '' else 'nan' for v in values], dtype=np.float64)
+
+
+def _jsonValues(values: np.ndarray) -> list:
+    result = values.tolist()
+    if np.isnan(values).any():
+        result = [None if v != v else v for v in result]
+    return result
+
+
+def toColumnar(times: List[str], values: List[str]) -> dict:
+    return {"timestamps": _epochMilliseconds(times).tolist(), "values": _jsonValues(_floatValues(values))}
+
+
+def toArray(times: List[str], values: List[str]) -> np.ndarray:
+    array = np.empty(len(times), dtype=NPY_DTYPE)
+    array['timestamp'] = _epochMilliseconds(times)
+    array['value'] = _floatValues(values)
+    return array
+
+
+def toNpy(times: List[str], values: List[str]) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, toArray(times, values), allow_pickle=False)
+    return buffer.getvalue()
+
+
+# encode one property (pid) in the requested format
+def encodeProperty(content: bytes, pid: str, format: str) -> bytes:
+    times, values = parseAnnotatedCsv(content).get(pid, ([], []))
+    if format == "columnar":
+        return json.dumps(toColumnar(times, values), separators=(',', ':')).encode('utf-8')
+    if format == "csv":
+        return ("timestamp,value,id\n" + "".join(f"{t},{v},{pid}\n" for t, v in zip(times, values))).encode('utf-8')
+    if format == "npy":
+        return toNpy(times, values)
+    raise ValueError(f"Invalid format: {format}")
+
+
+# encode several properties, titles maps pid -> property title used as key (npy is saved as npz archive)
+def encodeProperties(content: bytes, titles: Dict[str, str], format: str) -> bytes:
+    columns = parseAnnotatedCsv(content)
+    if format == "columnar":
+        data = {title: toColumnar(*columns.get(pid, ([], []))) for pid, title in titles.items()}
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+    if format == "csv":
+        lines = ["timestamp,value,id\n"]
+        for pid in titles:
+            times, values = columns.get(pid, ([], []))
+            lines.extend(f"{t},{v},{pid}\n" for t, v in zip(times, values))
+        return "".join(lines).encode('utf-8')
+    if format == "npy":
+        buffer = io.BytesIO()
+        np.savez(buffer, **{title: toArray(*columns.get(pid, ([], []))) for pid, title in titles.items()})
+        return buffer.getvalue()
+    raise ValueError(f"Invalid format: {format}")
+
+
+# same text as the json endpoint: parsed like FluxCsvParser does, serialized like jsonable_encoder does a datetime
+def _jsonTimestamp(time: str) -> str:
+    return get_date_helper().parse_date(time).isoformat()
+
+
+def _ndjsonRow(field: str, time: str, value: str) -> str:
+    return json.dumps({"timestamp": _jsonTimestamp(time), "value": float(value) if value != '' else None, "id": field}) + "\n"
+
+
+def _csvRow(field: str, time: str, value: str) -> str:
+    return f"{time},{value},{field}\n"
+
+
+# rows of a streamed query response as NDJSON or CSV, emitted in blocks of STREAM_FLUSH_ROWS rows
+async def streamRows(lines: AsyncIterator[str], format: str) -> AsyncIterator[bytes]:
+    encode = _ndjsonRow if format == "json" else _csvRow
+    reader = AnnotatedCsvRows()
+    if format == "csv":
+        yield b"timestamp,value,id\n"
+    block = []
+    async for line in lines:
+        record = reader.read(next(csv.reader([line]), []))
+        if record is None:
+            continue
+        block.append(encode(*record))
+        if len(block) >= STREAM_FLUSH_ROWS:
+            yield "".join(block).encode('utf-8')
+            block = []
+    if block:
+        yield "".join(block).encode('utf-8')
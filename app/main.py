@@ -1,14 +1,20 @@
 import signal
+import threading
 import time
 
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.openapi.utils import get_openapi
 from app.core.registrationHandler import initRegistrationCheck
 from app.routers.dataProcessingRouter import router as data_processing_router
 from app.routers.dataConsumptionRouter import router as data_consumption_router
 # from app.tools.logger import CustomLogger
 from app.core.Scheduler import Scheduler
+from app.core.ParserPool import ParserPool
+from app.core.SettingsWatcher import SettingsWatcher
+from app.core.dataProcessing import warmLatestValues
+from app.microservicies.InfluxAsyncConnector import InfluxAsyncConnector
+from app.tools import metrics
 import logging
 
 
@@ -30,6 +36,12 @@ def read_root():
     return
 
 
+# Prometheus scrape target, every instrument of app.tools.metrics
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
     response = {"message": "Not Found", "statusCode": 404}
@@ -51,11 +63,20 @@ def get_openapi_endpoint():
 async def shutdown_event():
     logger.info("Shutting down the service")
     scheduler.stop()
+    SettingsWatcher().stop()
+    ParserPool().stop()
+    await InfluxAsyncConnector().close()
 
-initRegistrationCheck()
+# registration talks to the node for every item, the server does not wait for it
+threading.Thread(target=initRegistrationCheck, name="registration-check", daemon=True).start()
+
+# latest values are answered from memory, load them in the background
+threading.Thread(target=warmLatestValues, name="latest-warmup", daemon=True).start()
 
 
 # plan scheduler in 10 seconds
 scheduler = Scheduler()
 scheduler.start()
 
+SettingsWatcher().start()
+
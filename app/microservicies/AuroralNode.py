@@ -1,10 +1,15 @@
 import json
 import os
+import time
 from dotenv import load_dotenv
 from typing import Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 
+from app.tools import metrics
+
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +18,19 @@ load_dotenv()
 auroral_node_sb: Optional[str] = os.getenv('AURORAL_NODE_SB')
 auroral_node_username: Optional[int] = os.getenv('AURORAL_NODE_USERNAME')
 auroral_node_password: Optional[str] = os.getenv('AURORAL_NODE_PASSWORD')
+AURORAL_POOL_SIZE: int = int(os.getenv('AURORAL_POOL_SIZE', 10))
+AURORAL_CONNECT_TIMEOUT: float = float(os.getenv('AURORAL_CONNECT_TIMEOUT', 5))
+AURORAL_READ_TIMEOUT: float = float(os.getenv('AURORAL_READ_TIMEOUT', 30))
+AURORAL_RETRIES: int = int(os.getenv('AURORAL_RETRIES', 3))
+AURORAL_RETRY_BACKOFF: float = float(os.getenv('AURORAL_RETRY_BACKOFF', 0.5))  # seconds, doubled on every retry
+# 5xx answers worth another try, the node or its gateway is restarting
+RETRY_STATUSES = (500, 502, 503, 504)
+
+request_latency = {
+    operation: metrics.histogram(f"auroral_{operation}_seconds", f"Latency of AURORAL node {operation} calls")
+    for operation in ("healthcheck", "oid", "register", "update")
+}
+request_errors = metrics.counter("auroral_request_errors_total", "AURORAL node calls that failed to connect or timed out")
 
 # Singleton class to connect to an Auroral service
 class AuroralNode:
@@ -26,13 +44,38 @@ class AuroralNode:
     def __init__(self) -> None:
         if not hasattr(self, 'initialized'):
             self.host = auroral_node_sb
+            # one session for all calls, connections are kept alive and reused across threads
+            self.session = requests.Session()
+            self.session.auth = (auroral_node_username, auroral_node_password)
+            # connect errors are retried for every call, 5xx and read errors only for GET and PUT (a POST may have registered the item)
+            retry = Retry(
+                total=AURORAL_RETRIES,
+                backoff_factor=AURORAL_RETRY_BACKOFF,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "PUT"]),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AURORAL_POOL_SIZE, max_retries=retry)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
             self.initialized = True
 
+    def _request(self, operation: str, method: str, path: str, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, f"{self.host}/{path}",
+                                        timeout=(AURORAL_CONNECT_TIMEOUT, AURORAL_READ_TIMEOUT), **kwargs)
+        except requests.RequestException:
+            request_errors.inc()
+            raise
+        finally:
+            request_latency[operation].observe(time.perf_counter() - start)
+
     def is_healthy(self) -> bool:
         try:
             path = "api/agent/healthcheck"
             # call healthcheck endpoint - if it returns 200, the service is healthy
-            response = requests.get(f"{self.host}/{path}", auth=(auroral_node_username, auroral_node_password))
+            response = self._request("healthcheck", "GET", path)
             logger.debug(f"Healthcheck response: {response.text}")
             if response.status_code != 200:
                 logger.error(f"Failed to connect to Auroral: {response.text}")
@@ -45,7 +88,7 @@ class AuroralNode:
     def getRegistartionOidByAdapterid(self, adapterId: str)-> str :
         try:
             path = "api/registration/oid/" + adapterId
-            response = requests.get(f"{self.host}/{path}", auth=(auroral_node_username, auroral_node_password))
+            response = self._request("oid", "GET", path)
             if response.status_code != 200:
                 logger.error(f"Failed to connect to Auroral Node: {response.text}")
                 return None
@@ -55,29 +98,33 @@ class AuroralNode:
         except Exception as e:
             logger.error(f"Failed to connect to Auroral Node: {e}")
             return None
-    # td is in json format
-    def registerItem(self, td: json) -> None:
+    # td is in json format, returns True when the node accepted it
+    def registerItem(self, td: json) -> bool:
         try:
             logger.info(f"Registering item")
             path = "api/registration"
-            response = requests.post(f"{self.host}/{path}", auth=(auroral_node_username, auroral_node_password), json=td)
+            response = self._request("register", "POST", path, json=td)
             if response.status_code != 201:
                 logger.error(f"Registration response: {response.text}")
                 raise Exception(f"Failed to register in node: {response.text}")                
+            return True
         except Exception as e:
             logger.error(f"Failed to register in node: {e}")
-    def updateItem(self, td: json) -> None:
+            return False
+    def updateItem(self, td: json) -> bool:
         try:
             logger.info(f"Updating item")
             path = "api/registration"
-            response = requests.put(f"{self.host}/{path}", auth=(auroral_node_username, auroral_node_password), json=td)
+            response = self._request("update", "PUT", path, json=td)
             if response.status_code != 200:
                 # logger.error(f"TD: {td}")
                 logger.error(f"Update response: {response.text}")
                 raise Exception(f"Failed to update in node: {response.text}")                
             else:
                 logger.info(f"Item updated")
+            return True
         except Exception as e:
             logger.error(f"Failed to update in node: {e}")
+            return False
         
 
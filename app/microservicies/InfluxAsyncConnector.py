@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from typing import AsyncIterator, List, Optional
+import logging
+
+import httpx
+from influxdb_client.client.flux_csv_parser import FluxCsvParser, FluxSerializationMode
+
+from app.microservicies.InfluxConnector import (
+    LATEST_RANGE, buildFluxQuery, buildLatestQuery, recordToDict, tablesToLatest,
+    influx_host, influx_port, influx_protocol, influx_token, influx_organization, query_errors, query_latency,
+)
+from app.tools import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+INFLUX_QUERY_CONCURRENCY: int = int(os.getenv('INFLUX_QUERY_CONCURRENCY', 16))
+INFLUX_QUERY_POOL_SIZE: int = int(os.getenv('INFLUX_QUERY_POOL_SIZE', 32))
+INFLUX_QUERY_TIMEOUT: float = float(os.getenv('INFLUX_QUERY_TIMEOUT', 30))
+
+query_wait = metrics.histogram("influx_query_wait_seconds", "Time queries waited for a free slot of INFLUX_QUERY_CONCURRENCY")
+
+# same annotated CSV the influxdb_client query api asks for, so records parse identically
+QUERY_DIALECT = {
+    "header": True,
+    "delimiter": ",",
+    "annotations": ["datatype", "group", "default"],
+    "commentPrefix": "#",
+    "dateTimeFormat": "RFC3339",
+}
+
+
+# FluxCsvParser reads an iterable of byte lines with close()
+class _BufferedResponse:
+    def __init__(self, content: bytes) -> None:
+        self._lines = content.splitlines(keepends=True)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def close(self) -> None:
+        self._lines = []
+
+
+# Singleton non-blocking InfluxDB query client for the FastAPI routers, one pooled httpx connection pool per process
+class InfluxAsyncConnector:
+    _instance: Optional['InfluxAsyncConnector'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'InfluxAsyncConnector':
+        if not cls._instance:
+            cls._instance = super(InfluxAsyncConnector, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.url = f"{influx_protocol}://{influx_host}:{influx_port}"
+            self.client: Optional[httpx.AsyncClient] = None
+            self.semaphore: Optional[asyncio.Semaphore] = None
+            self._loop = None
+            self.initialized = True
+
+    # created on first use, inside the event loop of the server (and again if the loop was replaced)
+    async def _getClient(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self.client is None or self._loop is not loop:
+            # pooled connections of the old loop can not be reused, release them instead of leaking the pool
+            await self.close()
+            self._loop = loop
+            self.client = httpx.AsyncClient(
+                base_url=self.url,
+                headers={"Authorization": f"Token {influx_token}", "Accept": "application/csv"},
+                limits=httpx.Limits(max_connections=INFLUX_QUERY_POOL_SIZE, max_keepalive_connections=INFLUX_QUERY_POOL_SIZE),
+                timeout=INFLUX_QUERY_TIMEOUT,
+            )
+            self.semaphore = asyncio.Semaphore(INFLUX_QUERY_CONCURRENCY)
+        return self.client
+
+    # raw annotated CSV response of a Flux query
+    async def query_csv(self, query: str) -> bytes:
+        client = await self._getClient()
+        waiting = time.perf_counter()
+        async with self.semaphore:
+            start = time.perf_counter()
+            query_wait.observe(start - waiting)
+            try:
+                response = await client.post(
+                    "/api/v2/query",
+                    params={"org": influx_organization},
+                    json={"query": query, "dialect": QUERY_DIALECT, "type": "flux"},
+                )
+            except Exception:
+                query_errors.inc()
+                raise
+            finally:
+                query_latency.observe(time.perf_counter() - start)
+        if response.status_code != 200:
+            query_errors.inc()
+            raise Exception(f"InfluxDB query failed ({response.status_code}): {response.text}")
+        return response.content
+
+    # response lines of a Flux query as they arrive, the pool slot is held until the iteration ends
+    async def stream_lines(self, query: str) -> AsyncIterator[str]:
+        client = await self._getClient()
+        waiting = time.perf_counter()
+        async with self.semaphore:
+            start = time.perf_counter()
+            query_wait.observe(start - waiting)
+            try:
+                async with client.stream(
+                    "POST",
+                    "/api/v2/query",
+                    params={"org": influx_organization},
+                    json={"query": query, "dialect": QUERY_DIALECT, "type": "flux"},
+                ) as response:
+                    query_latency.observe(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        await response.aread()
+                        raise Exception(f"InfluxDB query failed ({response.status_code}): {response.text}")
+                    async for line in response.aiter_lines():
+                        yield line
+            except Exception:
+                query_errors.inc()
+                raise
+
+    async def query(self, query: str) -> list:
+        content = await self.query_csv(query)
+        # parsing is CPU work, keep it off the event loop
+        return await asyncio.to_thread(_parseTables, content)
+
+    async def getData(self, pid: str, startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> list:
+        try:
+            tables = await self.query(buildFluxQuery([pid], startTimestamp, stopTimestamp, every, fn))
+            return [recordToDict(record) for table in tables for record in table.records]
+        except Exception as e:
+            logger.error(f"Failed to get data from InfluxDB: {e}")
+            raise e
+
+    async def getDataMultiple(self, pids: List[str], startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> dict:
+        try:
+            processed = {pid: [] for pid in pids}
+            if not pids:
+                return processed
+            tables = await self.query(buildFluxQuery(pids, startTimestamp, stopTimestamp, every, fn))
+            for table in tables:
+                for record in table.records:
+                    processed.setdefault(record.get_field(), []).append(recordToDict(record))
+            return processed
+        except Exception as e:
+            logger.error(f"Failed to get data from InfluxDB: {e}")
+            raise e
+
+    # last point of each field: {pid: (timestamp ns, value)}
+    async def getLatest(self, pids: List[str], startTimestamp: str = LATEST_RANGE) -> dict:
+        try:
+            if not pids:
+                return {}
+            tables = await self.query(buildLatestQuery(pids, startTimestamp))
+            return tablesToLatest(tables)
+        except Exception as e:
+            logger.error(f"Failed to get latest data from InfluxDB: {e}")
+            raise e
+
+    # raw annotated CSV of the fields, for encoders that do not need FluxRecords
+    async def getCsv(self, pids: List[str], startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> bytes:
+        try:
+            return await self.query_csv(buildFluxQuery(pids, startTimestamp, stopTimestamp, every, fn))
+        except Exception as e:
+            logger.error(f"Failed to get data from InfluxDB: {e}")
+            raise e
+
+    async def close(self) -> None:
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        try:
+            await client.aclose()
+        except Exception as e:
+            # sockets of an event loop that is already closed can only be dropped
+            logger.warning(f"Failed to close the InfluxDB client: {e}")
+
+
+def _parseTables(content: bytes) -> list:
+    parser = FluxCsvParser(response=_BufferedResponse(content), serialization_mode=FluxSerializationMode.tables)
+    list(parser.generator())
+    return parser.table_list()
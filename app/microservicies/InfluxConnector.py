@@ -1,10 +1,16 @@
 import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, Union
 import influxdb_client
 from influxdb_client.client.write_api import SYNCHRONOUS
 import logging
 
+from app.tools import metrics
+from app.tools.LatestValueStore import mergeLatest
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,6 +22,16 @@ influx_protocol: Optional[str] = os.getenv('INFLUX_PROTOCOL', 'http')
 influx_token: Optional[str] = os.getenv('INFLUX_TOKEN')
 influx_organization: Optional[str] = os.getenv('INFLUX_ORGANIZATION')
 influx_bucket: Optional[str] = os.getenv('INFLUX_BUCKET')
+influx_gzip: bool = os.getenv('INFLUX_GZIP', 'True').lower() == 'true'
+# how far back latest values are looked up in InfluxDB
+LATEST_RANGE: str = os.getenv('LATEST_RANGE', '-30d')
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+query_latency = metrics.histogram("influx_query_seconds", "Latency of InfluxDB queries, until the response is read (or its headers when streamed)")
+query_errors = metrics.counter("influx_query_errors_total", "InfluxDB queries that failed")
+write_latency = metrics.histogram("influx_write_seconds", "Latency of InfluxDB write calls, failed ones included")
+write_errors = metrics.counter("influx_write_errors_total", "InfluxDB write calls that failed")
 
 # Singleton class to connect to an InfluxDB service
 class InfluxConnector:
@@ -33,7 +49,8 @@ class InfluxConnector:
             self.client = influxdb_client.InfluxDBClient(
                 url=url,
                 token=influx_token,
-                org=influx_organization
+                org=influx_organization,
+                enable_gzip=influx_gzip
             )
             self.writeApi = self.client.write_api(write_options=SYNCHRONOUS)
             self.initialized = True
@@ -49,42 +66,168 @@ class InfluxConnector:
 
     def write_multiple_data(self, points: list[influxdb_client.Point]) -> None:
         logger.debug("Writing data to InfluxDB")
+        start = time.perf_counter()
         try:
             self.writeApi.write(bucket=influx_bucket, record=points)
         except Exception as e:
+            write_errors.inc()
+            logger.error(f"Failed to write data to InfluxDB: {e}")
+            raise e
+        finally:
+            write_latency.observe(time.perf_counter() - start)
+    # lines is a list of line protocol strings or one already encoded batch
+    def write_line_protocol(self, lines: Union[list[str], bytes]) -> None:
+        logger.debug("Writing line protocol to InfluxDB")
+        start = time.perf_counter()
+        try:
+            self.writeApi.write(bucket=influx_bucket, record=lines)
+        except Exception as e:
+            write_errors.inc()
             logger.error(f"Failed to write data to InfluxDB: {e}")
             raise e
+        finally:
+            write_latency.observe(time.perf_counter() - start)
     def write_single_data(self, point: influxdb_client.Point) -> None:
         logger.debug("Writing data to InfluxDB")
+        start = time.perf_counter()
         try:
             self.writeApi.write(bucket=influx_bucket, record=point)
         except Exception as e:
+            write_errors.inc()
             logger.error(f"Failed to write data to InfluxDB: {e}")
             raise e
+        finally:
+            write_latency.observe(time.perf_counter() - start)
         
-    def getData(self, pid: str, startTimestamp: str, stopTimestamp: str):
+    def _query(self, query: str):
+        start = time.perf_counter()
         try:
-            if(startTimestamp == ""):
-                startTimestamp = "-7d"
-            if(stopTimestamp == ""):
-                stopTimestamp = "now()"
-            query = f'from(bucket: "{influx_bucket}") |> range(start: {startTimestamp}, stop: {stopTimestamp}) \
-            |> filter(fn: (r) => r["_field"] == "{pid}") \
-            |> sort(columns: ["_time"], desc: true)'
-            # |> window(every: 1h)'
-            result = self.client.query_api().query(query=query)
+            return self.client.query_api().query(query=query)
+        except Exception:
+            query_errors.inc()
+            raise
+        finally:
+            query_latency.observe(time.perf_counter() - start)
+
+    def getData(self, pid: str, startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = ""):
+        try:
+            query = buildFluxQuery([pid], startTimestamp, stopTimestamp, every, fn)
+            result = self._query(query)
             # convert result to format {timestamp: value}
             processed = []
             for table in result:
                 for record in table.records:
-                    processed.append({
-                        "timestamp": record.get_time(),
-                        "value": record.get_value(),
-                        "id": record.get_field()
-                    })
+                    processed.append(recordToDict(record))
             return processed
         except Exception as e:
             logger.error(f"Failed to get data from InfluxDB: {e}")
             raise e
 
-   
+    # one Flux query for several fields, result split by field: {pid: [{timestamp, value, id}]}
+    def getDataMultiple(self, pids: list[str], startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> dict:
+        try:
+            processed = {pid: [] for pid in pids}
+            if not pids:
+                return processed
+            query = buildFluxQuery(pids, startTimestamp, stopTimestamp, every, fn)
+            result = self._query(query)
+            for table in result:
+                for record in table.records:
+                    processed.setdefault(record.get_field(), []).append(recordToDict(record))
+            return processed
+        except Exception as e:
+            logger.error(f"Failed to get data from InfluxDB: {e}")
+            raise e
+
+    # last point of each field within the range: {pid: (timestamp ns, value)}
+    def getLatest(self, pids: list[str], startTimestamp: str = LATEST_RANGE) -> dict:
+        try:
+            if not pids:
+                return {}
+            result = self._query(buildLatestQuery(pids, startTimestamp))
+            return tablesToLatest(result)
+        except Exception as e:
+            logger.error(f"Failed to get latest data from InfluxDB: {e}")
+            raise e
+
+
+def _fluxString(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def recordToDict(record) -> dict:
+    return {
+        "timestamp": record.get_time(),
+        "value": record.get_value(),
+        "id": record.get_field()
+    }
+
+
+def recordToLatest(record) -> tuple:
+    # Flux times have microsecond precision in the client
+    return record.get_field(), ((record.get_time() - _EPOCH) // timedelta(microseconds=1) * 1000, record.get_value())
+
+
+# {id: (timestamp ns, value)} of last() tables; a field written with several tag sets has one table per tag set,
+# the newest of their points wins
+def tablesToLatest(tables) -> dict:
+    latest = {}
+    for table in tables:
+        mergeLatest(latest, dict(recordToLatest(record) for record in table.records))
+    return latest
+
+
+# fn values accepted for aggregation, "derivative" turns cumulative POCITADLO counters into consumption per window
+AGGREGATE_FUNCTIONS = ("mean", "median", "last", "first", "min", "max", "sum", "count", "derivative")
+_DURATION = re.compile(r'^(\d+(ns|us|µs|ms|s|mo|m|h|d|w|y))+$')
+_DURATION_PART = re.compile(r'(\d+)(ns|us|µs|ms|s|mo|m|h|d|w|y)')
+_CALENDAR_UNITS = ("mo", "y")  # variable length, derivative() only takes a fixed unit
+
+
+# OR-chained equalities, unlike contains() they are pushed down to the storage engine
+def _fieldFilter(pids: list[str]) -> str:
+    return " or ".join(f'r["_field"] == {_fluxString(pid)}' for pid in pids)
+
+
+def buildFluxQuery(pids: list[str], startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> str:
+    if(startTimestamp == ""):
+        startTimestamp = "-7d"
+    if(stopTimestamp == ""):
+        stopTimestamp = "now()"
+    field_filter = _fieldFilter(pids)
+    query = f'from(bucket: "{influx_bucket}") |> range(start: {startTimestamp}, stop: {stopTimestamp}) \
+    |> filter(fn: (r) => {field_filter})'
+    if every or fn:
+        query += _aggregation(every, fn)
+    query += ' \
+    |> sort(columns: ["_time"], desc: true)'
+    return query
+
+
+def buildLatestQuery(pids: list[str], startTimestamp: str = LATEST_RANGE) -> str:
+    field_filter = _fieldFilter(pids)
+    return f'from(bucket: "{influx_bucket}") |> range(start: {startTimestamp}) \
+    |> filter(fn: (r) => {field_filter}) \
+    |> last()'
+
+
+# downsampling pushed down to InfluxDB, raises ValueError for invalid parameters
+def _aggregation(every: str, fn: str) -> str:
+    if not every:
+        raise ValueError("every is required for aggregation")
+    if not _DURATION.match(every):
+        raise ValueError(f"Invalid duration: {every}")
+    parts = _DURATION_PART.findall(every)
+    if not any(int(magnitude) for magnitude, _ in parts):
+        raise ValueError(f"Duration must be greater than zero: {every}")
+    fn = fn or "mean"
+    if fn not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"Invalid aggregate function: {fn}")
+    if fn == "derivative" and any(unit in _CALENDAR_UNITS for _, unit in parts):
+        raise ValueError(f"derivative needs a fixed duration, not months or years: {every}")
+    if fn == "derivative":
+        return f' \
+    |> aggregateWindow(every: {every}, fn: last, createEmpty: false) \
+    |> derivative(unit: {every}, nonNegative: true)'
+    return f' \
+    |> aggregateWindow(every: {every}, fn: {fn}, createEmpty: false)'
@@ -0,0 +1,178 @@
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from typing import List, Optional, Union
+import logging
+
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import MaxRetryError, ProtocolError, TimeoutError as Urllib3TimeoutError
+
+from app.microservicies.InfluxConnector import InfluxConnector
+from app.tools import metrics
+from app.tools.LatestValueStore import LatestValueStore
+from app.tools.QueryCache import QueryCache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# points per write request, the ingest encodes batches of this size
+INFLUX_BATCH_SIZE: int = int(os.getenv('INFLUX_BATCH_SIZE', 5000))
+# batches written at once: writer threads of the processing pipeline, and chunks of one oversized write()
+INFLUX_WRITE_CONCURRENCY: int = int(os.getenv('INFLUX_WRITE_CONCURRENCY', 4))
+INFLUX_WRITE_RETRIES: int = int(os.getenv('INFLUX_WRITE_RETRIES', 5))
+INFLUX_RETRY_BACKOFF: float = float(os.getenv('INFLUX_RETRY_BACKOFF', 1.0))  # seconds, doubled on every retry
+INFLUX_RETRY_MAX_BACKOFF: float = float(os.getenv('INFLUX_RETRY_MAX_BACKOFF', 30.0))
+INFLUX_SPILL_DIR: str = os.getenv('INFLUX_SPILL_DIR', 'influx_spill')
+
+batch_latency = metrics.histogram("influx_write_batch_seconds", "Latency of successful InfluxDB batch writes")
+batches_written = metrics.counter("influx_write_batches_total", "Batches written to InfluxDB")
+points_written = metrics.counter("influx_write_points_total", "Points written to InfluxDB")
+write_retries = metrics.counter("influx_write_retries_total", "Retried InfluxDB batch writes")
+batches_spilled = metrics.counter("influx_write_spilled_total", "Batches spilled to the local queue after retries ran out")
+spill_queue_depth = metrics.gauge("influx_spill_queue_depth", "Batches waiting in the local spill queue")
+
+
+# 429, 5xx, connection and timeout errors are transient; other API errors (bad line protocol, auth)
+# and anything else (a bug in the caller) are raised at once and never spilled
+def _isRetryable(e: Exception) -> bool:
+    if isinstance(e, ApiException):
+        return e.status is None or e.status == 429 or e.status >= 500
+    return isinstance(e, (ConnectionError, TimeoutError, ProtocolError, Urllib3TimeoutError, MaxRetryError))
+
+
+# measurement and tag set up to the first unescaped space, then the first field key
+_FIELD_KEY = re.compile(rb'^(?:[^ \\]|\\.)* ((?:[^=\\]|\\.)*)=', re.MULTILINE)
+_UNESCAPE = re.compile(rb'\\(.)')
+
+
+# field ids (pids) of the points in a line protocol batch
+def fieldKeys(body: bytes) -> set:
+    return {_UNESCAPE.sub(rb'\1', key).decode('utf-8') for key in _FIELD_KEY.findall(body)}
+
+
+# Singleton batched writer: chunks line protocol, writes chunks concurrently with retries,
+# and spills chunks that still fail to disk so they are replayed on the next processing run
+class InfluxWriter:
+    _instance: Optional['InfluxWriter'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'InfluxWriter':
+        if not cls._instance:
+            cls._instance = super(InfluxWriter, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.influxconnector = InfluxConnector()
+            self.executor = ThreadPoolExecutor(INFLUX_WRITE_CONCURRENCY, thread_name_prefix="influx-batch")
+            self.spill_dir = INFLUX_SPILL_DIR
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._replay_lock = threading.Lock()
+            self._sequence = itertools.count()
+            spill_queue_depth.set(len(self._spilledFiles()))
+            self.initialized = True
+
+    # lines is a list of line protocol strings or one encoded batch; returns once every chunk is written or spilled,
+    # True when InfluxDB acknowledged every chunk, False when some were spilled
+    def write(self, lines: Union[List[str], bytes]) -> bool:
+        chunks = self._chunk(lines)
+        if len(chunks) == 1:
+            return self._writeOrSpill(chunks[0])
+        futures = [self.executor.submit(self._writeOrSpill, chunk) for chunk in chunks]
+        errors = [f.exception() for f in futures]
+        for e in errors:
+            if e is not None:
+                raise e
+        return all(f.result() for f in futures)
+
+    def _chunk(self, lines: Union[List[str], bytes]) -> List[bytes]:
+        if isinstance(lines, bytes):
+            if lines.count(b"\n") < INFLUX_BATCH_SIZE:
+                return [lines]
+            lines = lines.split(b"\n")
+            return [b"\n".join(lines[i:i + INFLUX_BATCH_SIZE]) for i in range(0, len(lines), INFLUX_BATCH_SIZE)]
+        return ["\n".join(lines[i:i + INFLUX_BATCH_SIZE]).encode('utf-8') for i in range(0, len(lines), INFLUX_BATCH_SIZE)]
+
+    def _writeWithRetry(self, body: bytes) -> None:
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self.influxconnector.write_line_protocol(body)
+                batch_latency.observe(time.perf_counter() - start)
+                batches_written.inc()
+                points_written.inc(body.count(b"\n") + 1)
+                return
+            except Exception as e:
+                if not _isRetryable(e) or attempt >= INFLUX_WRITE_RETRIES:
+                    raise
+                # exponential backoff with full jitter
+                delay = random.uniform(0, min(INFLUX_RETRY_MAX_BACKOFF, INFLUX_RETRY_BACKOFF * 2 ** attempt))
+                attempt += 1
+                write_retries.inc()
+                logger.warning(f"Retrying InfluxDB write in {delay:.1f}s (attempt {attempt}/{INFLUX_WRITE_RETRIES})")
+                time.sleep(delay)
+
+    def _writeOrSpill(self, body: bytes) -> bool:
+        try:
+            self._writeWithRetry(body)
+            return True
+        except Exception as e:
+            if not _isRetryable(e):
+                raise
+            self._spill(body)
+            return False
+
+    def _spill(self, body: bytes) -> None:
+        name = f"{time.time_ns()}_{next(self._sequence):06d}.lp"
+        path = os.path.join(self.spill_dir, name)
+        # write to a temporary file first so a crash never leaves a partial batch in the queue
+        with open(path + ".tmp", 'wb') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        batches_spilled.inc()
+        spill_queue_depth.inc()
+        logger.error(f"InfluxDB write failed, spilled batch to {path}")
+
+    def _spilledFiles(self) -> List[str]:
+        return sorted(f for f in os.listdir(self.spill_dir) if f.endswith(".lp"))
+
+    # write spilled batches oldest first, stops at the first failure; returns number of replayed batches
+    def replay_spilled(self) -> int:
+        with self._replay_lock:
+            replayed = 0
+            pids = set()
+            files = self._spilledFiles()
+            spill_queue_depth.set(len(files))
+            for name in files:
+                path = os.path.join(self.spill_dir, name)
+                with open(path, 'rb') as f:
+                    body = f.read()
+                try:
+                    self._writeWithRetry(body)
+                except Exception as e:
+                    if _isRetryable(e):
+                        logger.error(f"Replaying spilled batches stopped at {name}: {e}")
+                        break
+                    # InfluxDB rejects the batch itself, keep it aside instead of blocking the queue
+                    logger.error(f"InfluxDB rejected spilled batch {name}, renaming to {name}.rejected: {e}")
+                    os.replace(path, path + ".rejected")
+                    spill_queue_depth.dec()
+                    continue
+                os.remove(path)
+                replayed += 1
+                spill_queue_depth.dec()
+                pids |= fieldKeys(body)
+            # cached query results of the replayed fields miss these points
+            QueryCache().invalidate(pids)
+            LatestValueStore().invalidate(pids)
+            if files:
+                logger.info(f"Replayed {replayed} of {len(files)} spilled InfluxDB batches")
+            return replayed
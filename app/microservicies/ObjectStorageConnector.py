@@ -1,10 +1,14 @@
 import io
+import time
 import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from botocore.response import StreamingBody
 import os
 import logging
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Iterable, Iterator, Optional
+from app.tools import metrics
+from app.tools.ProcessedStateIndex import ProcessedStateIndex
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +23,99 @@ endpoint_url: Optional[str] = os.getenv('ENDPOINT_URL')
 processed_tag: str = 'processedToInflux'
 # 
 process_everything: Optional[bool] = os.getenv('PROCESS_EVERYTHING', 'False').lower() == 'true'
+# skip listing keys up to the last fully processed one, only valid while keys are lexically ordered (file_YYYYmmddHHMMSS.csv)
+listing_watermark: bool = os.getenv('LISTING_WATERMARK', 'False').lower() == 'true'
+
+# S3 multipart parts must be at least 5 MiB, except the last one
+UPLOAD_PART_SIZE: int = max(int(os.getenv('UPLOAD_PART_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+
+request_latency = {
+    operation: metrics.histogram(f"s3_{operation}_seconds", f"Latency of S3 {operation} calls, the count is the number of calls")
+    for operation in ("list", "get", "get_tagging", "put_tagging", "put", "create_upload", "upload_part", "complete_upload")
+}
+request_errors = metrics.counter("s3_request_errors_total", "S3 calls that raised an error")
+
+
+# one S3 client call, timed under its operation name
+def _timed(operation: str, function, **kwargs):
+    start = time.perf_counter()
+    try:
+        return function(**kwargs)
+    except Exception:
+        request_errors.inc()
+        raise
+    finally:
+        request_latency[operation].observe(time.perf_counter() - start)
+
+
+# listing pages as they are fetched, each page is one list call
+def _timedPages(pages) -> Iterator[dict]:
+    iterator = iter(pages)
+    while True:
+        start = time.perf_counter()
+        try:
+            page = next(iterator)
+        except StopIteration:
+            return
+        except Exception:
+            request_errors.inc()
+            raise
+        request_latency["list"].observe(time.perf_counter() - start)
+        yield page
+
+
+# Object written part by part as data arrives; files smaller than one part are stored with a single PUT
+class MultipartUpload:
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int = UPLOAD_PART_SIZE) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._uploadPart(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _uploadPart(self, data: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = _timed("create_upload", self.s3_client.create_multipart_upload, Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = _timed("upload_part", self.s3_client.upload_part,
+                          Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def complete(self) -> None:
+        if self.upload_id is None:
+            _timed("put", self.s3_client.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._uploadPart(bytes(self.buffer))
+            _timed(
+                "complete_upload", self.s3_client.complete_multipart_upload,
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+        logger.info(f"File {self.key} uploaded to {self.bucket}/{self.key} ({self.size} bytes, {max(1, len(self.parts))} parts)")
+
+    # drop the parts uploaded so far, the object is not created
+    def abort(self) -> None:
+        self.buffer = bytearray()
+        self.size = 0
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.error(f"Error aborting upload of {self.key}: {e}")
+            self.upload_id = None
+            self.parts = []
+
 
 # Singleton class to connect to an object storage service
 class ObjectStorageConnector:
@@ -38,6 +135,7 @@ class ObjectStorageConnector:
                 aws_secret_access_key=aws_secret_access_key,
             )
             self.bucket_name = bucket_name
+            self.processed_index = ProcessedStateIndex()
             self.initialized = True
 
     def is_healthy(self) -> bool:
@@ -55,7 +153,7 @@ class ObjectStorageConnector:
     def get_file(self, filename: str) -> io.BytesIO:
         logger.debug("Getting file")
         try:
-            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=filename)
+            response = _timed("get", self.s3_client.get_object, Bucket=self.bucket_name, Key=filename)
             return io.BytesIO(response.get('Body').read())
         except FileNotFoundError:
             logger.error(f"The file {filename} was not found")
@@ -66,63 +164,131 @@ class ObjectStorageConnector:
         except PartialCredentialsError:
             logger.error("Incomplete credentials provided")
             return io.BytesIO()
-        
-        
-    def list_unprocessed_files(self) -> list:
+
+    # body of the object as botocore StreamingBody, read it incrementally with iter_chunks()
+    def get_file_stream(self, filename: str) -> Optional[StreamingBody]:
+        logger.debug("Getting file stream")
+        try:
+            # timed until the headers arrive, the body is streamed by the caller
+            response = _timed("get", self.s3_client.get_object, Bucket=self.bucket_name, Key=filename)
+            return response.get('Body')
+        except FileNotFoundError:
+            logger.error(f"The file {filename} was not found")
+            return None
+        except NoCredentialsError:
+            logger.error("Credentials not available")
+            return None
+        except PartialCredentialsError:
+            logger.error("Incomplete credentials provided")
+            return None
+
+    # yields keys of unprocessed files page by page, following continuation tokens
+    def list_unprocessed_files(self) -> Iterator[str]:
         logger.debug("Listing unprocessed files")
         try:
-            listResponse = self.s3_client.list_objects_v2(Bucket=self.bucket_name)
+            paginator = self.s3_client.get_paginator('list_objects_v2')
             if(process_everything):
+                for page in _timedPages(paginator.paginate(Bucket=self.bucket_name)):
+                    for obj in page.get('Contents', []):
+                        yield obj.get('Key')
+                return
+            watermark = self.processed_index.get_watermark() if listing_watermark else None
+            if watermark:
+                logger.debug(f"Listing files after {watermark}")
+                pages = _timedPages(paginator.paginate(Bucket=self.bucket_name, StartAfter=watermark))
+            else:
+                pages = _timedPages(paginator.paginate(Bucket=self.bucket_name))
+            known = self.processed_index.snapshot()
+            listed = set()
+            lookups = 0
+            for page in pages:
+                changed = []
                 unprocessed_files = []
-                for obj in listResponse.get('Contents', []):
+                for obj in page.get('Contents', []):
                     filename = obj.get('Key')
-                    unprocessed_files.append(filename)
-                return unprocessed_files
-            unprocessed_files = []
-            for obj in listResponse.get('Contents', []):
-                filename = obj.get('Key')
-                # get metadata
-                metadata = self.s3_client.get_object_tagging(Bucket=self.bucket_name, Key=filename)
-                tags = metadata.get('TagSet', [])
-                if not any(tag.get('Key') == processed_tag for tag in tags):
-                    # logger.info(f"File {filename} is unprocessed")
-                    unprocessed_files.append(filename)
-            return unprocessed_files
+                    etag = obj.get('ETag')
+                    listed.add(filename)
+                    state = known.get(filename)
+                    if state is not None and state[0] == etag:
+                        processed = state[1]
+                    else:
+                        # new or changed object - get metadata
+                        metadata = _timed("get_tagging", self.s3_client.get_object_tagging, Bucket=self.bucket_name, Key=filename)
+                        tags = metadata.get('TagSet', [])
+                        processed = any(tag.get('Key') == processed_tag for tag in tags)
+                        changed.append((filename, etag, processed))
+                    if not processed:
+                        # logger.info(f"File {filename} is unprocessed")
+                        unprocessed_files.append(filename)
+                self.processed_index.update(changed)
+                lookups += len(changed)
+                yield from unprocessed_files
+            # keys before the watermark were not listed, keep them
+            self.processed_index.remove([key for key in known if key not in listed and (not watermark or key > watermark)])
+            logger.debug(f"Looked up tags of {lookups} new or changed objects")
         except FileNotFoundError:
             logger.error("The bucket was not found")
-            return []
         except NoCredentialsError:
             logger.error("Credentials not available")
-            return []
         except PartialCredentialsError:
             logger.error("Incomplete credentials provided")
-            return []
-        
+
+    # the given keys that exist and are not tagged as processed, for runs targeted at notified files
+    def filter_unprocessed(self, keys: Iterable[str]) -> Iterator[str]:
+        for filename in keys:
+            if process_everything:
+                yield filename
+                continue
+            try:
+                metadata = _timed("get_tagging", self.s3_client.get_object_tagging, Bucket=self.bucket_name, Key=filename)
+            except Exception as e:
+                logger.error(f"Error getting tags of {filename}, skipping it: {e}")
+                continue
+            tags = metadata.get('TagSet', [])
+            if not any(tag.get('Key') == processed_tag for tag in tags):
+                yield filename
+
+    # move the listing watermark past every key that is already processed
+    def advance_listing_watermark(self) -> None:
+        if not listing_watermark or process_everything:
+            return
+        watermark = self.processed_index.advance_watermark()
+        logger.debug(f"Listing watermark: {watermark}")
+
     def mark_file_as_processed(self, filename: str) -> None:
         logger.debug("Marking file as processed")
         try:
             # get old tags 
-            metadata = self.s3_client.get_object_tagging(Bucket=self.bucket_name, Key=filename)
+            metadata = _timed("get_tagging", self.s3_client.get_object_tagging, Bucket=self.bucket_name, Key=filename)
             tags = metadata.get('TagSet', [])
             # add new tag
             tags.append({'Key': processed_tag, 'Value': 'true'})
-            self.s3_client.put_object_tagging(
+            _timed(
+                "put_tagging", self.s3_client.put_object_tagging,
                 Bucket=self.bucket_name,
                 Key=filename,
                 Tagging={
                     'TagSet': tags
                 }
             )
+            self.processed_index.set_processed(filename)
         except FileNotFoundError:
             logger.error(f"The file {filename} was not found")
         except NoCredentialsError:
             logger.error("Credentials not available")
         except Exception as e:
             logger.error(f"Error marking file as processed: {e}")
+
+    # drop the local processed state index and rebuild it from object tags
+    def resync_processed_index(self) -> int:
+        logger.info("Resyncing processed state index")
+        self.processed_index.clear()
+        return sum(1 for _ in self.list_unprocessed_files())
+
     def push_to_storage_error(self, file_data: io.BytesIO, file_name: str) -> None:
         logger.debug("Pushing to storage(error)")
         try:
-            self.s3_client.upload_fileobj(file_data, error_bucket_name, str(file_name))
+            _timed("put", self.s3_client.upload_fileobj, Fileobj=file_data, Bucket=error_bucket_name, Key=str(file_name))
             logger.info(f"File {file_name} uploaded to {self.bucket_name}/{file_name}")
         except FileNotFoundError:
             logger.error(f"The file {file_name} was not found")
@@ -131,10 +297,14 @@ class ObjectStorageConnector:
         except PartialCredentialsError:
             logger.error("Incomplete credentials provided")
 
+    # upload written in parts as the data arrives, call complete() or abort() when done
+    def open_upload(self, file_name: str) -> MultipartUpload:
+        return MultipartUpload(self.s3_client, self.bucket_name, str(file_name))
+
     def push_to_storage(self, file_data: io.BytesIO, file_name: str) -> None:
         logger.debug("Pushing to storage")
         try:
-            self.s3_client.upload_fileobj(file_data, self.bucket_name, str(file_name))
+            _timed("put", self.s3_client.upload_fileobj, Fileobj=file_data, Bucket=self.bucket_name, Key=str(file_name))
             logger.info(f"File {file_name} uploaded to {self.bucket_name}/{file_name}")
         except FileNotFoundError:
             logger.error(f"The file {file_name} was not found")
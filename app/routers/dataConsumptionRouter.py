@@ -1,10 +1,20 @@
+import asyncio
 import json
 import logging
 import time
+from datetime import datetime, timedelta, timezone
 from fastapi import APIRouter, Request, Response, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from app.microservicies.InfluxConnector import InfluxConnector
+from app.microservicies.InfluxAsyncConnector import InfluxAsyncConnector
+from app.microservicies.InfluxConnector import buildFluxQuery
+from app.core.responseFormats import (
+    FORMATS, MEDIA_TYPES, STREAM_FORMATS, STREAM_MEDIA_TYPES, encodeProperties, encodeProperty, streamRows,
+)
 from app.tools.Settings import Settings
+from app.tools.QueryCache import MISSING, QueryCache
+from app.tools.LatestValueStore import NO_DATA, LatestValueStore
+from app.tools import metrics
 from app.tools.logger import CustomLogger
 
 
@@ -13,25 +23,139 @@ from app.tools.logger import CustomLogger
 
 security = HTTPBasic()
 logger = logging.getLogger(__name__)
-influxconnector = InfluxConnector()
+influxasyncconnector = InfluxAsyncConnector()
 
 
 router = APIRouter()
+querycache = QueryCache()
+latestvalues = LatestValueStore()
+property_latency = metrics.histogram("property_request_seconds", "Latency of property requests")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# query results are cached until the ingest writes new points of the field or the TTL expires;
+# the generation is read before the query, so a result fetched while new points were written is not cached
+async def getCachedData(pid: str, startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = ""):
+    key = (pid, startTimestamp, stopTimestamp, every, fn)
+    data = querycache.get(key)
+    if data is MISSING:
+        generation = querycache.generation(pid)
+        data = await influxasyncconnector.getData(pid, startTimestamp, stopTimestamp, every, fn)
+        querycache.put(key, data, generation)
+    return data
+
+
+# cached fields are answered from the cache, the rest is fetched with a single multi-field query
+async def getCachedDataMultiple(pids: list, startTimestamp: str, stopTimestamp: str, every: str = "", fn: str = "") -> dict:
+    data = {}
+    missing = []
+    for pid in pids:
+        value = querycache.get((pid, startTimestamp, stopTimestamp, every, fn))
+        if value is MISSING:
+            missing.append(pid)
+        else:
+            data[pid] = value
+    if missing:
+        generations = {pid: querycache.generation(pid) for pid in missing}
+        fetched = await influxasyncconnector.getDataMultiple(missing, startTimestamp, stopTimestamp, every, fn)
+        for pid in missing:
+            data[pid] = fetched.get(pid, [])
+            querycache.put((pid, startTimestamp, stopTimestamp, every, fn), data[pid], generations[pid])
+    return data
+
+
+# latest values answered from the table fed by the ingest, fields it does not know yet are looked up once;
+# fields without any point are remembered as such until the ingest writes them
+async def getLatestValues(pids: list) -> dict:
+    data = {}
+    missing = []
+    for pid in pids:
+        point = latestvalues.get(pid)
+        if point is None:
+            missing.append(pid)
+        elif point is not NO_DATA:
+            data[pid] = point
+    if missing:
+        generation = latestvalues.generation()
+        fetched = await influxasyncconnector.getLatest(missing)
+        # before update(), which bumps the generation itself
+        latestvalues.mark_empty([pid for pid in missing if pid not in fetched], generation)
+        latestvalues.update(fetched)
+        data.update(fetched)
+    return {
+        pid: [{"timestamp": _EPOCH + timedelta(microseconds=point[0] // 1000), "value": point[1], "id": pid}]
+        for pid, point in data.items()
+    }
+
+
+# property values in one of the compact formats, encoded from the raw query CSV off the event loop
+async def getEncodedData(pid: str, startTimestamp: str, stopTimestamp: str, every: str, fn: str, format: str) -> Response:
+    key = (pid, startTimestamp, stopTimestamp, every, fn, format)
+    payload = querycache.get(key)
+    if payload is MISSING:
+        generation = querycache.generation(pid)
+        content = await influxasyncconnector.getCsv([pid], startTimestamp, stopTimestamp, every, fn)
+        payload = await asyncio.to_thread(encodeProperty, content, pid, format)
+        querycache.put(key, payload, generation)
+    return Response(content=payload, media_type=MEDIA_TYPES[format])
+
+
+# rows are sent while InfluxDB returns them; the first line is awaited here so query errors are still a 404
+async def getStreamedData(pids: list, startTimestamp: str, stopTimestamp: str, every: str, fn: str, format: str) -> StreamingResponse:
+    lines = influxasyncconnector.stream_lines(buildFluxQuery(pids, startTimestamp, stopTimestamp, every, fn))
+    try:
+        first = await lines.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def body():
+        if first is not None:
+            yield first
+            async for line in lines:
+                yield line
+
+    async def rows():
+        try:
+            async for chunk in streamRows(body(), format):
+                yield chunk
+        finally:
+            await lines.aclose()
+
+    return StreamingResponse(rows(), media_type=STREAM_MEDIA_TYPES[format])
+
 
 # define router getProperty, no credentials adapterId in query and propertyName in query
 @router.get("/{adapterId}/property/{pid}",
             summary="Get Property",
-            description="Get the value of a property",
+            description="Get the value of a property. Optional every (Flux duration, e.g. 1h) and fn "
+                        "(mean, median, last, first, min, max, sum, count, derivative) downsample the values in InfluxDB. "
+                        "format=columnar returns {timestamps: [epoch ms], values: []}, format=csv a CSV file "
+                        "and format=npy a NumPy array of (timestamp, value) records (npz archive keyed by title for getAll). "
+                        "stream=true sends the rows as they are read from InfluxDB, as NDJSON (format=json) or CSV (format=csv). "
+                        "latest=true returns only the latest value, without querying InfluxDB.",
             responses={
                 200: {"description": "Property value returned"},
                 400: {"description": "Bad Request. Invalid parameters"}
             }
     )
-async def get_property(request: Request, adapterId: str = "", pid: str = "", startTimestamp: str = "", stopTimestamp: str = ""):
+async def get_property(request: Request, adapterId: str = "", pid: str = "", startTimestamp: str = "", stopTimestamp: str = "",
+                       every: str = "", fn: str = "", format: str = "json", stream: bool = False,
+                       latest: bool = False):
     """
     Endpoint to get the value of a property.
     """
+    requested = time.perf_counter()
     try:
+        if format not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid format: {format}, use one of {', '.join(FORMATS)}")
+        if stream and format not in STREAM_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Format {format} can not be streamed, use one of {', '.join(STREAM_FORMATS)}")
+        if latest and (every or fn or stream or format != "json" or startTimestamp or stopTimestamp):
+            raise HTTPException(status_code=400, detail="latest can not be combined with a time range, aggregation, format or stream")
+        if every or fn:
+            # validate before querying, so invalid parameters are a 400 and not a missing property
+            buildFluxQuery([pid], startTimestamp, stopTimestamp, every, fn)
         # start time for measuring how long the function takes
         starttime = time.time()
         logger.info(f"Getting property {pid} for adapter {adapterId} from {startTimestamp} to {stopTimestamp}")
@@ -39,13 +163,8 @@ async def get_property(request: Request, adapterId: str = "", pid: str = "", sta
         if pid == "getAll":
             # we have adapterId -> we need to find object id and all monitored properties
             # it is in settings.json
-            items = Settings().get_items()
+            item = Settings().get_item(adapterId)
             enabled_data_points = Settings().get_enabled_data_points()
-            item = None
-            for i in items:
-                if i.get('adapterid') == adapterId:
-                    item = i
-                    break
             if item is None:
                 logger.error(f"Adapter {adapterId} not found in settings")
                 # respond with error json 
@@ -54,32 +173,54 @@ async def get_property(request: Request, adapterId: str = "", pid: str = "", sta
             data = {}
             middle_time = time.time()
             logger.info(f"Middle time for getting properties for adapter {adapterId} took {middle_time-starttime} seconds")
-            import concurrent.futures
-
-            def fetch_property_data(pid):
-                title = enabled_data_points[pid].get('title')
-                return title, influxconnector.getData(pid, startTimestamp, stopTimestamp)
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_to_pid = {executor.submit(fetch_property_data, pid): pid for pid in properties_ids}
-                for future in concurrent.futures.as_completed(future_to_pid):
-                    pid = future_to_pid[future]
-                    try:
-                        title, property_data = future.result()
-                        data[title] = property_data
-                    except Exception as exc:
-                        logger.error(f"Error fetching data for property {pid}: {exc}")
+            if latest:
+                latest_data = await getLatestValues([p for p in properties_ids if p in enabled_data_points])
+                return {enabled_data_points[p].get('title'): values for p, values in latest_data.items()}
+            if stream:
+                pids = [p for p in properties_ids if p in enabled_data_points]
+                return await getStreamedData(pids, startTimestamp, stopTimestamp, every, fn, format)
+            if format != "json":
+                titles = {p: enabled_data_points[p].get('title') for p in properties_ids if p in enabled_data_points}
+                content = await influxasyncconnector.getCsv(list(titles), startTimestamp, stopTimestamp, every, fn)
+                payload = await asyncio.to_thread(encodeProperties, content, titles, format)
+                logger.info(f"Getting all properties for adapter {adapterId} took {time.time()-middle_time} seconds")
+                return Response(content=payload, media_type=MEDIA_TYPES[format])
+            try:
+                property_data = await getCachedDataMultiple(properties_ids, startTimestamp, stopTimestamp, every, fn)
+            except Exception as exc:
+                logger.error(f"Error fetching data for properties of adapter {adapterId}: {exc}")
+                property_data = {}
+            for pid, values in property_data.items():
+                details = enabled_data_points.get(pid)
+                if details is None:
+                    logger.error(f"Error fetching data for property {pid}: not found in enabled_data_points")
+                    continue
+                data[details.get('title')] = values
             # end time for measuring how long the function takes
             endtime = time.time()
             logger.info(f"Getting all properties for adapter {adapterId} took {endtime-middle_time} seconds")
             return data
+        elif latest:
+            return (await getLatestValues([pid])).get(pid, [])
+        elif stream:
+            return await getStreamedData([pid], startTimestamp, stopTimestamp, every, fn, format)
+        elif format != "json":
+            response = await getEncodedData(pid, startTimestamp, stopTimestamp, every, fn, format)
+            logger.info(f"Getting property {pid} for adapter {adapterId} took {time.time()-starttime} seconds")
+            return response
         else:
-            data = influxconnector.getData(pid, startTimestamp, stopTimestamp)
+            data = await getCachedData(pid, startTimestamp, stopTimestamp, every, fn)
             endtime = time.time()
             logger.info(f"Getting property {pid} for adapter {adapterId} took {endtime-starttime} seconds")
             return data
     except HTTPException as e:
         raise
+    except ValueError as e:
+        logger.error(f"Invalid parameters for property {pid}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting property {pid} for adapter {adapterId} from {startTimestamp} to {stopTimestamp}: {e}")
-        raise HTTPException(status_code=404, detail="Property: "+pid+" not found")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="Property: "+pid+" not found")
+    finally:
+        # streamed responses are counted until the first row is ready
+        property_latency.observe(time.perf_counter() - requested)
\ No newline at end of file
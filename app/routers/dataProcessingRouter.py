@@ -1,17 +1,19 @@
 # app/routers/csvProcessing.py
 
-import csv
-import io
 import logging
 from typing import Annotated
-from fastapi import APIRouter, Body, Request, Response, HTTPException
+from fastapi import APIRouter, Request, Response, HTTPException
+from fastapi.responses import JSONResponse
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from datetime import datetime
+from urllib.parse import unquote_plus
 from typing import Optional
 from app.tools.logger import CustomLogger
 from fastapi.security import HTTPBasic, HTTPBasicCredentials  
 from app.core.Scheduler import Scheduler
+from app.core.UploadManager import UploadManager
+from app.core.dataProcessing import DIRECT_UPLOAD_INGEST, completeIngest, ingestLines
 
 security = HTTPBasic()
 logger = logging.getLogger(__name__)
@@ -51,9 +53,26 @@ async def get_health():
         logger.error(f"Error checking health of the service: {e}")
         return Response(status_code=503)
 
+# object keys named by a notification: S3 event records ({"Records": [{"s3": {"object": {"key": ...}}}]})
+# or {"keys": [...]}; None when it names none, then every unprocessed file is processed
+def notifiedKeys(body) -> Optional[list]:
+    if not isinstance(body, dict):
+        return None
+    keys = []
+    for record in body.get("Records") or []:
+        s3 = record.get("s3", {})
+        bucket = s3.get("bucket", {}).get("name")
+        key = s3.get("object", {}).get("key")
+        if key and (bucket is None or bucket == s3connector.bucket_name):
+            # keys in S3 event records are URL encoded
+            keys.append(unquote_plus(key))
+    keys.extend(k for k in body.get("keys") or [] if isinstance(k, str) and k)
+    return keys or None
+
 @router.post("/notify",
             summary="Notify",
-            description="Notify the service that a new file has been uploaded",
+            description="Notify the service that a new file has been uploaded. A JSON body with S3 event records "
+                        "or {\"keys\": [...]} processes only the named files, otherwise all unprocessed files are processed",
             responses={
                 200: {"description": "Notification received"},
                 400: {"description": "Bad Request. Invalid notification format"}
@@ -65,8 +84,14 @@ async def put_notify(request: Request, credentials: Annotated[HTTPBasicCredentia
     """
     try:
         logger.info("Received a notification")
-        Scheduler().process_on_demand()
         # Check if the Content-Type is 'application/json'
+        keys = None
+        if request.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                keys = notifiedKeys(await request.json())
+            except ValueError:
+                logger.info("Notification body is not valid JSON, processing all files")
+        Scheduler().process_on_demand(keys)
         return Response(status_code=200)
     except HTTPException as e:
         raise e
@@ -74,61 +99,90 @@ async def put_notify(request: Request, credentials: Annotated[HTTPBasicCredentia
         logger.error(f"Error processing notification: {e}")
         raise HTTPException(status_code=400, detail="Invalid notification format")
 
+@router.post("/resync",
+            summary="Resync processed index",
+            description="Rebuild the local index of processed files from the object storage tags",
+            responses={
+                200: {"description": "Index rebuilt", "content": {"application/json": {"example": {"unprocessed": 0}}}},
+                500: {"description": "Resync failed"}
+            }
+    )
+def post_resync(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
+    """
+    Endpoint to drop the local processed state index and rebuild it from S3 tags.
+    """
+    try:
+        logger.info("Resyncing processed state index")
+        unprocessed = s3connector.resync_processed_index()
+        return {"unprocessed": unprocessed}
+    except Exception as e:
+        logger.error(f"Error resyncing processed state index: {e}")
+        raise HTTPException(status_code=500, detail="Resync failed")
+
 
 @router.post("/upload_csv",
              summary="Upload CSV file",
-             description="Upload a CSV file for processing",
+             description="Upload a CSV file for processing. The file is streamed to the object storage, "
+                         "the response carries the id of the upload job",
+             status_code=202,
+             openapi_extra={"requestBody": {"required": True, "content": {"text/csv": {"schema": {"type": "string"}}}}},
              responses={
-                200: {"description": "CSV file accepted for processing","content": None},
+                202: {"description": "CSV file accepted for processing", "content": {"application/json": {"example": {"job_id": "4f1c...", "file_name": "file_20240101120000.csv"}}}},
                 415: {"description": "Unsupported Media Type. Only .csv files are allowed.", "content": None},
                 400: {"description": "Bad Request. Invalid file format or other issues."}
                 },
     )
-async def post_csv(request: Request, credentials: Annotated[HTTPBasicCredentials, Depends(security)], file: bytes = Body(..., media_type="text/csv") , file_name: Optional[str] = None):
+async def post_csv(request: Request, credentials: Annotated[HTTPBasicCredentials, Depends(security)], file_name: Optional[str] = None):
     """
     Endpoint to accept a CSV file for processing.
     """
+    logger.debug("Received a CSV file for processing")
+    # Check if the Content-Type is 'text/csv'
+    content_type = request.headers.get("Content-Type")
+    if content_type != "text/csv":
+        raise HTTPException(status_code=415, detail="Only 'text/csv' files are allowed.")
+
+    # Generate file name - take whatever is in query parameter and append timestamp (remove.csv if present)
+    if file_name is None:
+        file_name = f"file_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+    else:
+        file_name = file_name.split(".")[0] + f"_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+
+    # transcoding, row counting and the upload to object storage run in a worker thread while the body arrives
+    job = UploadManager().start(
+        file_name, s3connector, lambda job: Scheduler().process_on_demand([job.file_name]),
+        # opt-in: points are written to InfluxDB from the same stream, the file is tagged as processed once stored
+        ingest=ingestLines if DIRECT_UPLOAD_INGEST else None,
+        on_ingested=lambda job, latest: completeIngest(job.file_name, latest),
+    )
     try:
-        logger.debug("Received a CSV file for processing")
-        # Check if the Content-Type is 'text/csv'
-        content_type = request.headers.get("Content-Type")
-        if content_type != "text/csv":
-            raise HTTPException(status_code=415, detail="Only 'text/csv' files are allowed.")
-        
-        # Generate file name - take whatever is in query parameter and append timestamp (remove.csv if present)
-        if file_name is None:
-            file_name = f"file_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-        else:
-            file_name = file_name.split(".")[0] + f"_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-        
-        
-        # Log file size
-        file_size = len(file)
-        fileStr = ""
-        try:
-            # try utf-8
-            fileStr = file.decode("utf-8")
-        except UnicodeDecodeError:
-            # try Windows-1252
-            fileStr = file.decode("Windows-1250")
-        file_stream = io.BytesIO(fileStr.encode("utf-8"))
-        # parse csv
-        csv_reader = csv.reader(io.StringIO(fileStr))
-        # number of rows
-        num_rows = len(list(csv_reader))
-        logger.debug(f"Uploaded file  {file_name} with size {file_size} bytes and {num_rows} rows")
-        # Push to object storage
-        s3connector.push_to_storage(file_stream, file_name)
-        Scheduler().process_on_demand()
-        return Response(status_code=200, content=None)
-        # Return a 200 OK response without any message
-    except HTTPException as e:
-        raise e
+        async for chunk in request.stream():
+            if chunk:
+                await job.put(chunk)
+        job.end()
     except Exception as e:
-        try:
-            # push to error bucket
-            s3connector.push_to_storage_error(io.BytesIO(file), file_name)
-        except Exception as e:
-            logger.error(f"Error pushing file to error bucket: {e}")
-        print(f"Error processing CSV file: {e}")
+        logger.error(f"Error receiving CSV file {file_name}: {e}")
+        job.end(e)
         raise HTTPException(status_code=400, detail="Invalid file format or other issues.")
+    finally:
+        # the handler was cancelled (client gone, shutdown), the worker must not wait for more chunks
+        job.end(Exception("upload was cancelled"))
+    return JSONResponse(status_code=202, content={"job_id": job.id, "file_name": file_name})
+
+
+@router.get("/upload_csv/{job_id}",
+            summary="Upload status",
+            description="Status of an uploaded CSV file: receiving, uploading, uploaded, ingested (written to InfluxDB directly) or failed",
+            responses={
+                200: {"description": "Upload job status"},
+                404: {"description": "Unknown upload job"}
+            }
+    )
+async def get_upload(job_id: str, credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
+    """
+    Endpoint to get the status of an upload job.
+    """
+    job = UploadManager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job: "+job_id+" not found")
+    return job.to_dict()
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from typing import Dict, Iterable, Optional, Set, Tuple, Union
+import logging
+
+from app.tools import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# the table holds the high-water marks of SKIP_INGESTED_ROWS, which must survive a restart, so it is persisted by default then;
+# otherwise empty keeps the table in memory only
+LATEST_VALUES_FILE: str = os.getenv('LATEST_VALUES_FILE') or (
+    'latest_values.sqlite' if os.getenv('SKIP_INGESTED_ROWS', 'False').lower() == 'true' else '')
+
+NO_DATA = object()  # returned by get() for an id InfluxDB was asked about and had no point of
+
+latest_hits = metrics.counter("latest_value_hits_total", "Latest value reads answered from the latest value table")
+latest_misses = metrics.counter("latest_value_misses_total", "Latest value reads that had to query InfluxDB")
+
+
+# merge {id: (timestamp ns, value)} of the latest points into target, keeping the newer point of each id
+def mergeLatest(target: dict, latest: dict) -> None:
+    for id, point in latest.items():
+        current = target.get(id)
+        if current is None or point[0] >= current[0]:
+            target[id] = point
+
+
+# Singleton table of the latest written point of every data point id: id -> (timestamp ns, value),
+# fed by the ingest pipeline after a file is written and optionally persisted to SQLite
+class LatestValueStore:
+    _instance: Optional['LatestValueStore'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'LatestValueStore':
+        if not cls._instance:
+            cls._instance = super(LatestValueStore, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self._lock = threading.Lock()
+            self._values: Dict[str, Tuple[int, float]] = {}
+            # ids without any point in InfluxDB, in memory only; bumped generation drops lookups that raced a write
+            self._empty: Set[str] = set()
+            self._generation = 0
+            self.connection = None
+            if LATEST_VALUES_FILE:
+                self.connection = sqlite3.connect(LATEST_VALUES_FILE, check_same_thread=False)
+                with self.connection:
+                    self.connection.execute(
+                        "CREATE TABLE IF NOT EXISTS latest (id TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, value REAL)"
+                    )
+                rows = self.connection.execute("SELECT id, timestamp, value FROM latest").fetchall()
+                self._values = {id: (timestamp, value) for id, timestamp, value in rows}
+                logger.info(f"Loaded {len(self._values)} latest values from {LATEST_VALUES_FILE}")
+            self.initialized = True
+
+    # the point, NO_DATA for an id known to have none, None when InfluxDB has to be asked
+    def get(self, id: str) -> Union[Tuple[int, float], object, None]:
+        point = self._values.get(id)
+        if point is None and id in self._empty:
+            point = NO_DATA
+        if point is None:
+            latest_misses.inc()
+        else:
+            latest_hits.inc()
+        return point
+
+    # {id: timestamp ns} of the latest ingested point, rows up to it were already written
+    def high_water_marks(self) -> Dict[str, int]:
+        with self._lock:
+            return {id: point[0] for id, point in self._values.items()}
+
+    # points older than the stored ones are ignored, so replays and warm-up never move a value back
+    def update(self, points: Dict[str, Tuple[int, float]]) -> None:
+        if not points:
+            return
+        with self._lock:
+            self._generation += 1
+            self._empty.difference_update(points)
+            changed = []
+            for id, point in points.items():
+                current = self._values.get(id)
+                if current is None or point[0] >= current[0]:
+                    self._values[id] = point
+                    changed.append((id, point[0], point[1]))
+            if self.connection is not None and changed:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT INTO latest (id, timestamp, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET timestamp = excluded.timestamp, value = excluded.value "
+                        "WHERE excluded.timestamp >= latest.timestamp",
+                        changed,
+                    )
+
+    # read before asking InfluxDB, then passed to mark_empty()
+    def generation(self) -> int:
+        return self._generation
+
+    # remember ids InfluxDB had no point of, unless points were written or invalidated since generation was read
+    def mark_empty(self, ids: Iterable[str], generation: int) -> None:
+        with self._lock:
+            if self._generation != generation:
+                return
+            self._empty.update(id for id in ids if id not in self._values)
+
+    # points of these ids were written without being recorded here (spilled or partly written), ask InfluxDB again
+    def invalidate(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            self._generation += 1
+            self._empty.difference_update(ids)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._values),
+            "empty": len(self._empty),
+            "hits": int(latest_hits.value),
+            "misses": int(latest_misses.value),
+        }
+
+
+metrics.callback_gauge("latest_value_entries", "Data points in the latest value table", lambda: len(LatestValueStore()._values))
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from typing import Dict, Iterable, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+PROCESSED_INDEX_FILE: str = os.getenv('PROCESSED_INDEX_FILE', 'processed_index.sqlite')
+
+# Singleton local index of S3 objects: key -> (ETag, processed), so only new or changed objects need a tag lookup
+class ProcessedStateIndex:
+    _instance: Optional['ProcessedStateIndex'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'ProcessedStateIndex':
+        if not cls._instance:
+            cls._instance = super(ProcessedStateIndex, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self._lock = threading.Lock()
+            self.connection = sqlite3.connect(PROCESSED_INDEX_FILE, check_same_thread=False)
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, etag TEXT, processed INTEGER NOT NULL)"
+                )
+                self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            logger.info(f"Processed state index: {PROCESSED_INDEX_FILE}")
+            self.initialized = True
+
+    def snapshot(self) -> Dict[str, Tuple[str, bool]]:
+        with self._lock:
+            rows = self.connection.execute("SELECT key, etag, processed FROM objects").fetchall()
+        return {key: (etag, bool(processed)) for key, etag, processed in rows}
+
+    def update(self, entries: Iterable[Tuple[str, str, bool]]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO objects (key, etag, processed) VALUES (?, ?, ?)",
+                ((key, etag, int(processed)) for key, etag, processed in entries),
+            )
+
+    def set_processed(self, key: str, processed: bool = True) -> None:
+        with self._lock, self.connection:
+            self.connection.execute("UPDATE objects SET processed = ? WHERE key = ?", (int(processed), key))
+
+    def remove(self, keys: Iterable[str]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM objects WHERE key = ?", ((key,) for key in keys))
+
+    def get_watermark(self) -> Optional[str]:
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE name = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    # watermark = greatest key such that it and every indexed key before it are processed
+    def advance_watermark(self) -> Optional[str]:
+        with self._lock, self.connection:
+            first_unprocessed = self.connection.execute("SELECT MIN(key) FROM objects WHERE processed = 0").fetchone()[0]
+            if first_unprocessed is None:
+                row = self.connection.execute("SELECT MAX(key) FROM objects WHERE processed = 1").fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT MAX(key) FROM objects WHERE processed = 1 AND key < ?", (first_unprocessed,)
+                ).fetchone()
+            if row[0] is not None:
+                self.connection.execute(
+                    "INSERT INTO meta (name, value) VALUES ('watermark', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (row[0],),
+                )
+        return self.get_watermark()
+
+    # forget everything, the next listing looks up tags of all objects again
+    def clear(self) -> None:
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM objects")
+            self.connection.execute("DELETE FROM meta WHERE name = 'watermark'")
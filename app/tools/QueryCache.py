@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import Any, Hashable, Iterable, Optional, Tuple
+import logging
+
+from app.tools import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+QUERY_CACHE_SIZE: int = int(os.getenv('QUERY_CACHE_SIZE', 1024))  # 0 disables the cache
+QUERY_CACHE_TTL: float = float(os.getenv('QUERY_CACHE_TTL', 300))  # seconds
+
+cache_hits = metrics.counter("query_cache_hits_total", "Property reads answered from the query cache")
+cache_misses = metrics.counter("query_cache_misses_total", "Property reads that had to query InfluxDB")
+cache_evictions = metrics.counter("query_cache_evictions_total", "Entries evicted from the query cache because it was full")
+cache_invalidations = metrics.counter("query_cache_invalidations_total", "Entries dropped because new points were written")
+
+MISSING = object()  # returned by get() when the key is not cached
+
+
+# Singleton LRU + TTL cache of property query results, keys start with the field id (pid)
+class QueryCache:
+    _instance: Optional['QueryCache'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'QueryCache':
+        if not cls._instance:
+            cls._instance = super(QueryCache, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.maxsize = QUERY_CACHE_SIZE
+            self.ttl = QUERY_CACHE_TTL
+            self._lock = threading.Lock()
+            self._entries: 'OrderedDict[Tuple, Tuple[float, Any]]' = OrderedDict()
+            self._generations = {}  # pid -> number of invalidations, a result fetched across one is not cached
+            self.initialized = True
+
+    def get(self, key: Tuple[Hashable, ...]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                cache_hits.inc()
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+        cache_misses.inc()
+        return MISSING
+
+    # read before fetching a result, then passed to put()
+    def generation(self, pid: str) -> int:
+        return self._generations.get(pid, 0)
+
+    # generation is the value of generation(key[0]) before the result was fetched,
+    # the result is dropped when the field was invalidated since then
+    def put(self, key: Tuple[Hashable, ...], value: Any, generation: int) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                cache_evictions.inc()
+
+    # drop every entry of the given field ids
+    def invalidate(self, pids: Iterable[str]) -> None:
+        pids = set(pids)
+        if not pids:
+            return
+        with self._lock:
+            for pid in pids:
+                self._generations[pid] = self._generations.get(pid, 0) + 1
+            stale = [key for key in self._entries if key[0] in pids]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            cache_invalidations.inc(len(stale))
+            logger.debug(f"Invalidated {len(stale)} cached queries")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": int(cache_hits.value),
+            "misses": int(cache_misses.value),
+            "evictions": int(cache_evictions.value),
+            "invalidations": int(cache_invalidations.value),
+        }
+
+
+metrics.callback_gauge("query_cache_entries", "Entries in the query cache", lambda: len(QueryCache()._entries))
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import threading
+from dotenv import load_dotenv
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+REGISTRATION_CACHE_FILE: str = os.getenv('REGISTRATION_CACHE_FILE', 'registration_cache.json')
+
+
+def tdHash(td: dict) -> str:
+    return hashlib.sha256(json.dumps(td, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+# Singleton local record of the last TD accepted by the node for each item: adapterid -> {oid, hash}
+class RegistrationCache:
+    _instance: Optional['RegistrationCache'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'RegistrationCache':
+        if not cls._instance:
+            cls._instance = super(RegistrationCache, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self._lock = threading.Lock()
+            self._entries = {}
+            try:
+                with open(REGISTRATION_CACHE_FILE) as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error loading registration cache {REGISTRATION_CACHE_FILE}, starting empty: {e}")
+            self.initialized = True
+
+    # True when the node already has exactly this TD under this oid
+    def is_current(self, adapterid: str, oid: str, td_hash: str) -> bool:
+        entry = self._entries.get(adapterid)
+        return entry is not None and entry.get('oid') == oid and entry.get('hash') == td_hash
+
+    def put(self, adapterid: str, oid: Optional[str], td_hash: str) -> None:
+        with self._lock:
+            self._entries[adapterid] = {'oid': oid, 'hash': td_hash}
+            # replace the file in one step, a crash never leaves it half written
+            with open(REGISTRATION_CACHE_FILE + ".tmp", 'w') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+            os.replace(REGISTRATION_CACHE_FILE + ".tmp", REGISTRATION_CACHE_FILE)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(REGISTRATION_CACHE_FILE):
+                os.remove(REGISTRATION_CACHE_FILE)
@@ -1,19 +1,59 @@
+import copy
 import json
 import os
 from dotenv import load_dotenv
-from typing import Optional
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 SETTINGS_FILE: Optional[str] = os.getenv('SETTINGS_FILE')
+TD_TEMPLATE_FILE: str = 'app/templates/td.json'
+
+
+# Lookup structures built once per loaded settings file, never modified afterwards
+class SettingsIndex:
+    def __init__(self, settings: dict, td_template: Optional[dict]) -> None:
+        self.settings = settings
+        self.items: list = settings['items']
+        # plain dict, it is sent to the parser processes and has to stay picklable
+        self.enabled_data_points: dict = settings['enabled_data_points']
+        # sorted id array for the vectorized membership test of the ingest
+        self.enabled_ids: np.ndarray = np.array(sorted(self.enabled_data_points), dtype=str)
+        self.enabled_ids.flags.writeable = False
+        self.disabled_data_points: frozenset = frozenset(settings['disabled_data_points'])
+        self.items_by_adapterid: Mapping[str, dict] = MappingProxyType({i.get('adapterid'): i for i in self.items})
+        self.td_template = td_template
+
+    # inconsistencies that would break the TD of an item
+    def problems(self) -> List[str]:
+        problems = []
+        for item in self.items:
+            if not item.get('adapterid'):
+                problems.append(f"item {item.get('title')} has no adapterid")
+            for pid in item.get('properties') or []:
+                if pid not in self.enabled_data_points:
+                    problems.append(f"property {pid} of item {item.get('adapterid')} not found in enabled_data_points")
+        return problems
+
+
+def _loadTdTemplate() -> Optional[dict]:
+    try:
+        with open(TD_TEMPLATE_FILE) as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading td file: {e}")
+        return None
+
 
 # Singleton class to connect to an InfluxDB service
 class Settings:
     _instance: Optional['Settings'] = None
-    _settings: dict = {}
 
     def __new__(cls, *args, **kwargs) -> 'Settings':
         if not cls._instance:
@@ -21,8 +61,9 @@ class Settings:
         return cls._instance
 
     def __init__(self) -> None:
-        self.initialized = True
-        self._load_settings_file()
+        if not hasattr(self, 'initialized'):
+            self._load_settings_file()
+            self.initialized = True
 
     def _load_settings_file(self) -> None:
         # check if SETTINGS_FILE is set
@@ -33,23 +74,60 @@ class Settings:
         if not os.path.exists(SETTINGS_FILE):
             logger.error(f"SETTINGS_FILE {SETTINGS_FILE} does not exist")
             exit(1)
-        # load data points from file and store them in a list self.enabled_data_points
+        try:
+            self._index = self._readSettingsFile()
+        except Exception as e:
+            logger.error(f"Error loading settings file: {e}")
+            exit(1)
+
+    def _readSettingsFile(self) -> SettingsIndex:
+        # load settings string, convert to dict and build the lookup structures
         with open(SETTINGS_FILE) as f:
-            try:
-                # load settings string, convert to dict and store in self._settings
-                settings = f.read()
-                json_settings = json.loads(settings)
-                self._settings = json_settings
-            except Exception as e:
-                logger.error(f"Error loading settings file: {e}")
-                exit(1)
-
-    def get_enabled_data_points(self) -> list:
-        if(self._settings):
-            return self._settings['enabled_data_points']
-    def get_disabled_data_points(self) -> list:
-        if(self._settings):
-            return self._settings['disabled_data_points']
-    def get_items(self) -> dict:
-        return self._settings["items"]
+            json_settings = json.loads(f.read())
+        return SettingsIndex(json_settings, _loadTdTemplate())
+
+    # read the file again and swap in the new index in one assignment, readers see either the old or the new one;
+    # returns (old, new) index, or None when the file is invalid and the current settings stay in use
+    def reload(self) -> Optional[Tuple[SettingsIndex, SettingsIndex]]:
+        try:
+            index = self._readSettingsFile()
+        except Exception as e:
+            logger.error(f"Error reloading settings file, keeping current settings: {e}")
+            return None
+        problems = index.problems()
+        if problems:
+            logger.error(f"Invalid settings file, keeping current settings: {'; '.join(problems)}")
+            return None
+        old = self._index
+        self._index = index
+        logger.info(f"Reloaded settings: {len(index.items)} items, {len(index.enabled_data_points)} enabled data points")
+        return old, index
+
+    # the current index; a caller reading several tables takes it once, a reload may swap it at any time
+    @property
+    def index(self) -> SettingsIndex:
+        return self._index
+
+    def get_enabled_data_points(self) -> dict:
+        return self._index.enabled_data_points
+
+    def get_enabled_ids(self) -> np.ndarray:
+        return self._index.enabled_ids
+
+    def get_disabled_data_points(self) -> frozenset:
+        return self._index.disabled_data_points
+
+    def get_items(self) -> list:
+        return self._index.items
+
+    def get_item(self, adapterid: str) -> Optional[dict]:
+        return self._index.items_by_adapterid.get(adapterid)
+
+    def get_data_point(self, pid: str) -> Optional[dict]:
+        return self._index.enabled_data_points.get(pid)
 
+    # parsed td.json, a copy the caller may fill in
+    def get_td_template(self) -> Optional[dict]:
+        if self._index.td_template is None:
+            return None
+        return copy.deepcopy(self._index.td_template)
@@ -0,0 +1,76 @@
+import functools
+import os
+from datetime import datetime, timezone
+from typing import Optional
+import logging
+
+import pytz
+
+from app.tools import metrics
+
+logger = logging.getLogger(__name__)
+
+PM_TIME_FORMAT: str = "%d.%m.%Y %H:%M"
+LOCAL_TIMEZONE: str = "Europe/Bratislava"
+TIMESTAMP_CACHE_SIZE: int = int(os.getenv('TIMESTAMP_CACHE_SIZE', 65536))
+# which offset to use for the repeated hour in autumn: "standard" (CET, the previous behaviour) or "dst" (CEST)
+DST_AMBIGUOUS_POLICY: str = os.getenv('DST_AMBIGUOUS_POLICY', 'standard').lower()
+
+EPOCH = datetime.fromtimestamp(0, tz=timezone.utc)
+
+# Singleton class converting AOCS PM_TIME strings (local time) to UTC epoch nanoseconds
+class TimestampConverter:
+    _instance: Optional['TimestampConverter'] = None
+
+    def __new__(cls, *args, **kwargs) -> 'TimestampConverter':
+        if not cls._instance:
+            cls._instance = super(TimestampConverter, cls).__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not hasattr(self, 'initialized'):
+            self.timezone = pytz.timezone(LOCAL_TIMEZONE)
+            self.ambiguous_is_dst = DST_AMBIGUOUS_POLICY == 'dst'
+            self.ambiguous = 0
+            self.nonexistent = 0
+            # exports repeat the same few thousand PM_TIME values for every meter
+            self._cached_convert = functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)(self._convert)
+            self.initialized = True
+
+    def _convert(self, timestamp_csv: str) -> int:
+        timestamp_local = datetime.strptime(timestamp_csv, PM_TIME_FORMAT)
+        try:
+            localized = self.timezone.localize(timestamp_local, is_dst=None)
+        except pytz.exceptions.AmbiguousTimeError:
+            # last Sunday of October, 02:00-02:59 happens twice
+            self.ambiguous += 1
+            logger.warning(f"Ambiguous local time {timestamp_csv}, using {'CEST' if self.ambiguous_is_dst else 'CET'}")
+            localized = self.timezone.localize(timestamp_local, is_dst=self.ambiguous_is_dst)
+        except pytz.exceptions.NonExistentTimeError:
+            # last Sunday of March, 02:00-02:59 is skipped; read it as CET which is the same instant as 03:xx CEST
+            self.nonexistent += 1
+            logger.warning(f"Non-existent local time {timestamp_csv}, shifting forward by one hour")
+            localized = self.timezone.localize(timestamp_local, is_dst=False)
+        delta = localized.astimezone(pytz.utc) - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 10 ** 9 + delta.microseconds * 10 ** 3
+
+    def toUtcNanoseconds(self, timestamp_csv: str) -> int:
+        return self._cached_convert(timestamp_csv)
+
+    def stats(self) -> dict:
+        info = self._cached_convert.cache_info()
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+            "ambiguous": self.ambiguous,
+            "nonexistent": self.nonexistent,
+        }
+
+    def clear(self) -> None:
+        self._cached_convert.cache_clear()
+
+
+metrics.callback_gauge("timestamp_cache_entries", "PM_TIME strings in the timestamp conversion cache",
+                       lambda: TimestampConverter().stats()["size"])
@@ -0,0 +1,168 @@
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Minimal in-process metrics (counters, gauges, histograms), rendered in the Prometheus text format by render().
+# Instruments are updated per batch/file/request, never per CSV row.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: Dict[str, 'Metric'] = {}
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+# gauge read from a function when the metrics are rendered, for sizes other modules already track
+class CallbackGauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, function: Callable[[], float]) -> None:
+        super().__init__(name, description)
+        self.function = function
+
+    @property
+    def value(self) -> float:
+        return self.function()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    # (cumulative bucket counts, sum, count), read under the lock so they are consistent
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        seen = 0
+        for c in counts:
+            seen += c
+            cumulative.append(seen)
+        return cumulative, total, count
+
+    # approximate quantile from bucket bounds
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _register(metric: Metric) -> Metric:
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    return _register(Counter(name, description))
+
+
+def gauge(name: str, description: str) -> Gauge:
+    return _register(Gauge(name, description))
+
+
+def callback_gauge(name: str, description: str, function: Callable[[], float]) -> CallbackGauge:
+    return _register(CallbackGauge(name, description, function))
+
+
+def histogram(name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, description, buckets))
+
+
+def registry() -> Dict[str, Metric]:
+    with _registry_lock:
+        return dict(_registry)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _formatValue(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# every registered metric in the Prometheus text exposition format
+def render() -> str:
+    lines = []
+    for name, metric in sorted(registry().items()):
+        lines.append(f"# HELP {name} {metric.description}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        if isinstance(metric, Histogram):
+            cumulative, total, count = metric.snapshot()
+            for bound, seen in zip(metric.buckets + (float('inf'),), cumulative):
+                lines.append(f'{name}_bucket{{le="{_formatValue(bound)}"}} {seen}')
+            lines.append(f"{name}_sum {_formatValue(total)}")
+            lines.append(f"{name}_count {count}")
+        else:
+            try:
+                lines.append(f"{name} {_formatValue(metric.value)}")
+            except Exception:
+                # a failing callback drops its sample, not the whole page
+                lines.pop()
+                lines.pop()
+    return "\n".join(lines) + "\n"
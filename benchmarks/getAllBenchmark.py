@@ -0,0 +1,67 @@
+import argparse
+import concurrent.futures
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.microservicies.InfluxConnector import InfluxConnector
+from app.tools.Settings import Settings
+
+# Compare the getAll fan-out (one Flux query per property) with the single multi-field query.
+# Runs against the InfluxDB configured by the INFLUX_* variables and the item from SETTINGS_FILE.
+# Usage: python benchmarks/getAllBenchmark.py --adapter <adapterid> --iterations 20
+
+
+def fanOut(influxconnector: InfluxConnector, pids: list, start: str, stop: str) -> dict:
+    data = {}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        future_to_pid = {executor.submit(influxconnector.getData, pid, start, stop): pid for pid in pids}
+        for future in concurrent.futures.as_completed(future_to_pid):
+            data[future_to_pid[future]] = future.result()
+    return data
+
+
+def singleQuery(influxconnector: InfluxConnector, pids: list, start: str, stop: str) -> dict:
+    return influxconnector.getDataMultiple(pids, start, stop)
+
+
+def measure(name: str, fn, iterations: int) -> dict:
+    timings = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:8s} p50 {statistics.median(timings) * 1000:8.1f} ms  p99 {p99 * 1000:8.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--adapter', help="adapterid from the settings file, first item by default")
+    parser.add_argument('--start', default="")
+    parser.add_argument('--stop', default="")
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    items = Settings().get_items()
+    item = next((i for i in items if args.adapter is None or i.get('adapterid') == args.adapter), None)
+    if item is None:
+        sys.exit(f"Adapter {args.adapter} not found in settings")
+    pids = item.get('properties')
+    influxconnector = InfluxConnector()
+    print(f"Adapter {item.get('adapterid')}: {len(pids)} properties, {args.iterations} iterations")
+
+    fan_out = measure("fan-out", lambda: fanOut(influxconnector, pids, args.start, args.stop), args.iterations)
+    single = measure("single", lambda: singleQuery(influxconnector, pids, args.start, args.stop), args.iterations)
+    identical = all(fan_out.get(pid, []) == single.get(pid, []) for pid in pids)
+    print(f"results identical: {identical}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytz
+from influxdb_client import Point
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic
+from app.core.csvIngest import iterLineProtocolBatches
+
+# Compare rows/sec of the original DictReader + Point ingest loop with the columnar path in app.core.csvIngest.
+# Usage: python benchmarks/ingestBenchmark.py --rows 1000000 --meters 500
+
+
+# the per-row loop dataProcessing() used before the columnar path
+def legacyLineProtocol(lines, enabled_data_points, disabled_data_points) -> list:
+    measurements = csv.DictReader(lines, delimiter=';')
+    discovered = []
+    result = []
+    for m in measurements:
+        object_code = m['KOD_OBJEKTU']
+        meter_code = m['KOD_MERACA']
+        value = float(m['POCITADLO'])
+        meter_name = m['NAZOV_MERACA']
+        uid = m['UID']
+        energia = m['ENERGIA']
+        local_timezone = pytz.timezone("Europe/Bratislava")
+        timestamp_local = datetime.strptime(m['PM_TIME'], "%d.%m.%Y %H:%M")
+        timestamp_utc = local_timezone.localize(timestamp_local).astimezone(pytz.utc)
+        id = object_code + "_" + meter_code + "_" + uid
+        if enabled_data_points.get(id) is None:
+            if id not in disabled_data_points and id not in discovered:
+                discovered.append(id)
+            continue
+        point = (
+            Point("koor_processed_data")
+            .tag("energy", energia)
+            .tag("meter_name", meter_name)
+            .tag("object_code", object_code)
+            .field(id, value)
+            .time(timestamp_utc)
+        )
+        result.append(point.to_line_protocol())
+    return result
+
+
+def columnarLineProtocol(lines, enabled_data_points, disabled_data_points) -> list:
+    result = []
+    for batch in iterLineProtocolBatches(lines, enabled_data_points, disabled_data_points, set()):
+        result.extend(batch)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--meters', type=int, default=500)
+    parser.add_argument('--enabled-ratio', type=float, default=0.8)
+    parser.add_argument('--skip-legacy', action='store_true', help="only measure the columnar path")
+    args = parser.parse_args()
+
+    meter_list = synthetic.meters(args.meters)
+    config = synthetic.settings(meter_list, args.enabled_ratio)
+    enabled, disabled = config['enabled_data_points'], config['disabled_data_points']
+    lines = synthetic.csvText(args.rows, args.meters).splitlines()
+    print(f"Synthetic file: {args.rows} rows, {args.meters} meters, {len(enabled)} enabled")
+
+    start = time.perf_counter()
+    columnar = columnarLineProtocol(lines, enabled, disabled)
+    columnar_time = time.perf_counter() - start
+    print(f"columnar: {columnar_time:.2f}s, {args.rows / columnar_time:,.0f} rows/s, {len(columnar)} points")
+
+    if args.skip_legacy:
+        return
+    start = time.perf_counter()
+    legacy = legacyLineProtocol(lines, enabled, disabled)
+    legacy_time = time.perf_counter() - start
+    print(f"legacy:   {legacy_time:.2f}s, {args.rows / legacy_time:,.0f} rows/s, {len(legacy)} points")
+    print(f"speedup:  {legacy_time / columnar_time:.1f}x")
+    identical = "\n".join(legacy).encode() == "\n".join(columnar).encode()
+    print(f"line protocol identical: {identical}")
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import stubs, synthetic
+
+# End-to-end benchmark of dataProcessing(), post_csv, get_property and the registration check,
+# run against the local stand-ins of benchmarks/stubs.py instead of S3, InfluxDB and the AURORAL node.
+# Every scenario runs in a fresh process, so its peak RSS is its own.
+# Usage: python benchmarks/serviceBenchmark.py --rows 200000 --meters 500 --files 4 --json results.json
+#        python benchmarks/serviceBenchmark.py --scenarios ingest --compare results.json
+
+SCENARIOS = ("ingest", "upload", "property", "registration")
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# the app reads its configuration at import time, so this runs before anything from app is imported
+def configure(args, workdir: str, influx_port: int, auroral_port: int) -> dict:
+    meter_list = synthetic.meters(args.meters)
+    config = synthetic.settings(meter_list, args.enabled_ratio, args.items)
+    settings_file = os.path.join(workdir, "settings.json")
+    with open(settings_file, "w") as f:
+        json.dump(config, f)
+    os.environ.update({
+        "SETTINGS_FILE": settings_file,
+        "SETTINGS_WATCH": "False",
+        "INFLUX_HOST": "127.0.0.1",
+        "INFLUX_PORT": str(influx_port),
+        "INFLUX_PROTOCOL": "http",
+        "INFLUX_TOKEN": "benchmark",
+        "INFLUX_ORGANIZATION": "benchmark",
+        "INFLUX_BUCKET": "benchmark",
+        "INFLUX_SPILL_DIR": os.path.join(workdir, "influx_spill"),
+        "BUCKET_NAME": "benchmark",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "PROCESS_EVERYTHING": "False",
+        "PROCESSED_INDEX_FILE": os.path.join(workdir, "processed_index.sqlite"),
+        "AURORAL_NODE_SB": f"http://127.0.0.1:{auroral_port}",
+        "AURORAL_NODE_USERNAME": "benchmark",
+        "AURORAL_NODE_PASSWORD": "benchmark",
+        "ADAPTER_HOST": "http://127.0.0.1:8000",
+        "REGISTRATION_CACHE_FILE": os.path.join(workdir, "registration_cache.json"),
+        "LATEST_VALUES_FILE": "",
+        "PARSE_PROCESSES": str(args.parse_processes),
+        "QUERY_CACHE_SIZE": str(args.query_cache),
+        "DIRECT_UPLOAD_INGEST": str(args.direct_ingest),
+    })
+    # the TD template is read relative to the repository root
+    os.chdir(ROOT)
+    return config
+
+
+# one synthetic export per file, consecutive time ranges
+def exportFiles(args) -> list:
+    steps = math.ceil(args.rows / args.meters)
+    files = []
+    for i in range(args.files):
+        start = datetime(2024, 1, 1) + timedelta(minutes=15 * steps * i)
+        data = synthetic.csvText(args.rows, args.meters, start=start, seed=i).encode('utf-8')
+        files.append((f"file_{start:%Y%m%d%H%M%S}_{i:04d}.csv", data))
+    return files
+
+
+def percentiles(timings: list) -> dict:
+    timings = sorted(timings)
+    if not timings:
+        return {"p50": None, "p99": None, "count": 0}
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    return {"p50": timings[len(timings) // 2] * 1000, "p99": p99 * 1000, "count": len(timings)}
+
+
+def peakRss() -> dict:
+    # kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        # parser pool processes, once they exited
+        "peak_rss_children_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+# dataProcessing() over files already in the bucket: S3 download, parse, InfluxDB write, tagging
+def ingestScenario(args, s3: stubs.S3Stub, influx: stubs.InfluxStub, config: dict) -> dict:
+    from app.core import dataProcessing as processing
+    from app.core.ParserPool import ParserPool
+    from app.core.ProcessingPipeline import points_queued, rows_parsed
+
+    processing.s3connector.s3_client = s3
+    files = exportFiles(args)
+    for key, data in files:
+        s3.put(processing.s3connector.bucket_name, key, data)
+    start = time.perf_counter()
+    processing.dataProcessing()
+    elapsed = time.perf_counter() - start
+    ParserPool().stop()
+
+    tagged = [key for key, _ in files if key in s3.tagged]
+    rows = int(rows_parsed.value)
+    written = influx.stats()["lines_written"]
+    if len(tagged) != len(files) or written != int(points_queued.value):
+        raise RuntimeError(f"ingest incomplete: {len(tagged)}/{len(files)} files tagged, "
+                           f"{written}/{int(points_queued.value)} points written")
+    return {
+        "rows": rows,
+        "points": written,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed,
+        "latency_ms": {"file": percentiles([s3.tagged[key] - s3.first_read[key] for key in tagged])},
+    }
+
+
+# post_csv through the ASGI app: request until 202, then until the job is stored (or ingested with --direct-ingest)
+def uploadScenario(args, s3: stubs.S3Stub, influx: stubs.InfluxStub, config: dict) -> dict:
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from app.core.UploadManager import UploadManager
+    from app.routers.dataProcessingRouter import router, s3connector
+
+    s3connector.s3_client = s3
+    app = FastAPI()
+    app.include_router(router, prefix="/processing")
+    final = ("ingested", "failed") if args.direct_ingest else ("uploaded", "ingested", "failed")
+    files = exportFiles(args)
+
+    accepted, completed = [], []
+    rows = 0
+    size = 0
+    # one event loop for all requests, like a running server
+    with TestClient(app) as client:
+        start = time.perf_counter()
+        for i, (key, data) in enumerate(files):
+            requested = time.perf_counter()
+            response = client.post(
+                "/processing/upload_csv", params={"file_name": f"upload{i}.csv"},
+                content=(data[j:j + UPLOAD_CHUNK_SIZE] for j in range(0, len(data), UPLOAD_CHUNK_SIZE)),
+                headers={"Content-Type": "text/csv"}, auth=("benchmark", "benchmark"),
+            )
+            accepted.append(time.perf_counter() - requested)
+            if response.status_code != 202:
+                raise RuntimeError(f"upload rejected ({response.status_code}): {response.text}")
+            job = UploadManager().get(response.json()["job_id"])
+            while job.status not in final:
+                time.sleep(0.001)
+            completed.append(time.perf_counter() - requested)
+            if job.status == "failed":
+                raise RuntimeError(f"upload {key} failed: {job.error}")
+            rows += job.rows - 1
+            size += len(data)
+        elapsed = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "points": influx.stats()["lines_written"],
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed,
+        "mib_per_second": size / elapsed / (1024 * 1024),
+        "latency_ms": {"accepted": percentiles(accepted), "completed": percentiles(completed)},
+    }
+
+
+# get_property through the ASGI app: single properties, getAll of the first item and streamed CSV
+def propertyScenario(args, s3: stubs.S3Stub, influx: stubs.InfluxStub, config: dict) -> dict:
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from app.routers.dataConsumptionRouter import router
+
+    app = FastAPI()
+    app.include_router(router, prefix="/consumption")
+    item = config["items"][0]
+    pids = item["properties"]
+    adapterid = item["adapterid"]
+    heavy = max(1, args.requests // 10)
+    requests = [("single", f"/consumption/{adapterid}/property/{pids[i % len(pids)]}", {}) for i in range(args.requests)]
+    requests += [("getAll", f"/consumption/{adapterid}/property/getAll", {}) for _ in range(heavy)]
+    requests += [("stream", f"/consumption/{adapterid}/property/{pids[i % len(pids)]}", {"stream": "true", "format": "csv"})
+                 for i in range(heavy)]
+
+    timings = {"single": [], "getAll": [], "stream": []}
+    points = 0
+    # one event loop for all requests, the pooled InfluxDB client is reused like in a running server
+    with TestClient(app) as client:
+        start = time.perf_counter()
+        for kind, url, params in requests:
+            requested = time.perf_counter()
+            response = client.get(url, params={"startTimestamp": "-7d", **params})
+            timings[kind].append(time.perf_counter() - requested)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} failed ({response.status_code}): {response.text[:200]}")
+            if kind == "single":
+                points += len(response.json())
+        elapsed = time.perf_counter() - start
+    return {
+        "rows": points,
+        "unit": "points",
+        "queries": influx.stats()["queries"],
+        "seconds": elapsed,
+        "rows_per_second": points / sum(timings["single"]),
+        "latency_ms": {kind: percentiles(values) for kind, values in timings.items()},
+    }
+
+
+# registration check of every item: a first run registers them, a second one finds them unchanged
+def registrationScenario(args, s3: stubs.S3Stub, influx: stubs.InfluxStub, config: dict) -> dict:
+    from app.core import registrationHandler
+
+    timings = []
+    outcomes = []
+    check = registrationHandler.checkRegistration
+
+    # _checkAll looks the function up on every run, per item timings without touching the handler
+    def timedCheck(item):
+        start = time.perf_counter()
+        try:
+            outcome = check(item)
+            outcomes.append(outcome)
+            return outcome
+        finally:
+            timings.append(time.perf_counter() - start)
+
+    registrationHandler.checkRegistration = timedCheck
+    result = {"latency_ms": {}, "seconds": 0.0}
+    for run, expected in (("register", "registered"), ("unchanged", "unchanged")):
+        timings.clear()
+        outcomes.clear()
+        start = time.perf_counter()
+        registrationHandler.initRegistrationCheck()
+        result["seconds"] += time.perf_counter() - start
+        if outcomes.count(expected) != len(config["items"]):
+            raise RuntimeError(f"registration {run} run: {outcomes}")
+        result["latency_ms"][run] = percentiles(timings)
+    items = len(config["items"])
+    result["rows"] = items * 2
+    result["unit"] = "checks"
+    result["rows_per_second"] = result["rows"] / result["seconds"]
+    return result
+
+
+SCENARIO_FUNCTIONS = {
+    "ingest": ingestScenario,
+    "upload": uploadScenario,
+    "property": propertyScenario,
+    "registration": registrationScenario,
+}
+
+
+def runScenario(name: str, args) -> dict:
+    influx = stubs.InfluxStub(points=args.points, delay=args.influx_delay / 1000)
+    auroral = stubs.AuroralStub(delay=args.auroral_delay / 1000)
+    with tempfile.TemporaryDirectory(prefix="aocs-benchmark-") as workdir:
+        config = configure(args, workdir, influx.start(), auroral.start())
+        try:
+            result = SCENARIO_FUNCTIONS[name](args, stubs.S3Stub(), influx, config)
+            # while the stub processes still run, so RUSAGE_CHILDREN only covers the parser pool
+            result.update(peakRss())
+        finally:
+            influx.stop()
+            auroral.stop()
+    return result
+
+
+def printResult(name: str, result: dict, baseline: dict = None) -> None:
+    def change(path):
+        value, old = result, baseline
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+            old = old.get(key) if isinstance(old, dict) else None
+        if value is None or not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.1f}%)"
+
+    print(f"{name:13s} {result['rows_per_second']:>12,.0f} {result.get('unit', 'rows')}/s{change(['rows_per_second'])}  "
+          f"{result['seconds']:.2f}s  peak RSS {result['peak_rss_mib']:.0f} MiB{change(['peak_rss_mib'])}")
+    for series, latency in result["latency_ms"].items():
+        if latency["count"]:
+            print(f"  {series:11s} p50 {latency['p50']:9.1f} ms{change(['latency_ms', series, 'p50'])}  "
+                  f"p99 {latency['p99']:9.1f} ms{change(['latency_ms', series, 'p99'])}  n={latency['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--rows', type=int, default=200000, help="rows per synthetic file")
+    parser.add_argument('--meters', type=int, default=500)
+    parser.add_argument('--enabled-ratio', type=float, default=0.8)
+    parser.add_argument('--files', type=int, default=4, help="files ingested or uploaded")
+    parser.add_argument('--items', type=int, default=20, help="items in the settings file")
+    parser.add_argument('--requests', type=int, default=200, help="single property requests")
+    parser.add_argument('--points', type=int, default=672, help="points per field returned by the InfluxDB stub")
+    parser.add_argument('--parse-processes', type=int, default=0, help="PARSE_PROCESSES of the ingest")
+    parser.add_argument('--query-cache', type=int, default=0, help="QUERY_CACHE_SIZE, 0 measures every query")
+    parser.add_argument('--direct-ingest', action='store_true', help="DIRECT_UPLOAD_INGEST for the upload scenario")
+    parser.add_argument('--influx-delay', type=float, default=0.0, help="ms added to every InfluxDB stub call")
+    parser.add_argument('--auroral-delay', type=float, default=20.0, help="ms added to every AURORAL stub call")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results file of an earlier run, changes are printed next to the values")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(runScenario(args.child, args)))
+        return
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIO_FUNCTIONS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f).get("results", {})
+
+    print(f"{args.files} files x {args.rows} rows, {args.meters} meters, {args.items} items, python {platform.python_version()}")
+    results = {}
+    for name in names:
+        # a fresh interpreter per scenario: clean singletons and its own peak RSS
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--child", name],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if not os.getenv("BENCHMARK_LOGS") else None, text=True,
+        )
+        if child.returncode != 0 or not child.stdout.strip():
+            sys.exit(f"Scenario {name} failed, run with BENCHMARK_LOGS=1 to see its output")
+        results[name] = json.loads(child.stdout.strip().splitlines()[-1])
+        printResult(name, results[name], baseline.get(name))
+
+    if args.json:
+        parameters = {key: value for key, value in vars(args).items() if key not in ("json", "compare", "child")}
+        with open(args.json, "w") as f:
+            json.dump({"parameters": parameters, "python": platform.python_version(), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+import abc
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import re
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+from botocore.response import StreamingBody
+
+# Local stand-ins for the services the adapter talks to, used by serviceBenchmark.py.
+# S3 is an in-process client object, InfluxDB and the AURORAL node are HTTP servers on 127.0.0.1,
+# so the real influxdb_client, httpx and requests code paths are measured. The servers run in their
+# own process, they do not compete with the measured code for the GIL.
+
+
+# In-process replacement for the boto3 S3 client, only the calls ObjectStorageConnector makes
+class S3Stub:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.objects = {}  # (bucket, key) -> bytes
+        self.tags = {}  # (bucket, key) -> TagSet
+        self.uploads = {}  # upload id -> {part number: bytes}
+        self.first_read = {}  # key -> perf_counter of the first get_object
+        self.tagged = {}  # key -> perf_counter of the last put_object_tagging
+
+    def put(self, bucket: str, key: str, data: bytes) -> None:
+        with self._lock:
+            self.objects[(bucket, key)] = data
+            self.tags.pop((bucket, key), None)
+
+    def list_buckets(self) -> dict:
+        return {"Buckets": [{"Name": bucket} for bucket in sorted({b for b, _ in self.objects})]}
+
+    def get_paginator(self, operation: str) -> '_ListPaginator':
+        assert operation == 'list_objects_v2'
+        return _ListPaginator(self)
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise FileNotFoundError(Key)
+        self.first_read.setdefault(Key, time.perf_counter())
+        return {"Body": StreamingBody(io.BytesIO(data), len(data)), "ContentLength": len(data)}
+
+    def get_object_tagging(self, Bucket: str, Key: str) -> dict:
+        return {"TagSet": list(self.tags.get((Bucket, Key), []))}
+
+    def put_object_tagging(self, Bucket: str, Key: str, Tagging: dict) -> dict:
+        self.tags[(Bucket, Key)] = list(Tagging['TagSet'])
+        self.tagged[Key] = time.perf_counter()
+        return {}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> dict:
+        self.put(Bucket, Key, bytes(Body))
+        return {"ETag": _etag(Body)}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str) -> None:
+        self.put(Bucket, Key, Fileobj.read())
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        with self._lock:
+            upload_id = f"upload-{len(self.uploads)}-{time.perf_counter_ns()}"
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> dict:
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": _etag(Body)}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict) -> dict:
+        parts = self.uploads.pop(UploadId)
+        self.put(Bucket, Key, b"".join(parts[p['PartNumber']] for p in MultipartUpload['Parts']))
+        return {}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> dict:
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+class _ListPaginator:
+    def __init__(self, s3: S3Stub) -> None:
+        self.s3 = s3
+
+    def paginate(self, Bucket: str, StartAfter: str = "", PageSize: int = 1000):
+        keys = sorted(key for bucket, key in list(self.s3.objects) if bucket == Bucket and key > StartAfter)
+        for start in range(0, max(1, len(keys)), PageSize):
+            yield {"Contents": [
+                {"Key": key, "ETag": _etag(self.s3.objects[(Bucket, key)])} for key in keys[start:start + PageSize]
+            ]}
+
+
+def _etag(data: bytes) -> str:
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+# HTTP stand-in served from a spawned process; counters are read back with stats()
+class _StubServer(abc.ABC):
+    name = "stub"
+
+    def __init__(self) -> None:
+        self.port = None
+        self.process = None
+
+    def counters(self) -> dict:
+        return {}
+
+    # request handler class of the server, built in the child process
+    @abc.abstractmethod
+    def handler(self) -> type:
+        ...
+
+    def _serve(self, connection) -> None:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        server.daemon_threads = True
+        connection.send(server.server_address[1])
+        server.serve_forever()
+
+    def start(self) -> int:
+        context = multiprocessing.get_context('spawn')
+        parent, child = context.Pipe()
+        # the stub is pickled for the child before the process is attached to it
+        process = context.Process(target=self._serve, args=(child,), name=self.name, daemon=True)
+        process.start()
+        self.process = process
+        self.port = parent.recv()
+        return self.port
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_stats") as response:
+            return json.load(response)
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+
+class _JsonHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def _send(self, status: int, body=b"", content_type: str = "application/json") -> None:
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stats(self) -> bool:
+        if self.path != "/_stats":
+            return False
+        self._send(200, self.stub.counters())
+        return True
+
+    def log_message(self, *args):
+        pass
+
+
+_FLUX_HEADER = (
+    "#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,double,string,string,string,string,string\r\n"
+    "#group,false,false,true,true,false,false,true,true,true,true,true\r\n"
+    "#default,_result,,,,,,,,,,\r\n"
+    ",result,table,_start,_stop,_time,_value,_field,_measurement,energy,meter_name,object_code\r\n"
+)
+_FIELD = re.compile(r'r\["_field"\] == ("(?:[^"\\]|\\.)*")')
+
+
+def _queriedFields(query: str) -> list:
+    return [json.loads(field) for field in _FIELD.findall(query)]
+
+
+# InfluxDB v2 HTTP API stand-in: counts written line protocol, answers every Flux query with
+# `points` rows per queried field (one for last() queries) in the annotated CSV of a real server
+class InfluxStub(_StubServer):
+    name = "influx-stub"
+
+    def __init__(self, points: int = 672, delay: float = 0.0) -> None:
+        super().__init__()
+        self.points = points
+        self.delay = delay
+        self.lines_written = 0
+        self.writes = 0
+        self.queries = 0
+        self._tables = {}
+
+    def counters(self) -> dict:
+        return {"lines_written": self.lines_written, "writes": self.writes, "queries": self.queries}
+
+    def _table(self, field: str, table: int, rows: int) -> str:
+        cached = self._tables.get((field, rows))
+        if cached is None:
+            stop = datetime(2024, 3, 25, tzinfo=timezone.utc)
+            start = stop - timedelta(days=7)
+            prefix = f",,{{table}},{start:%Y-%m-%dT%H:%M:%SZ},{stop:%Y-%m-%dT%H:%M:%SZ},"
+            lines = []
+            for i in range(rows):
+                timestamp = stop - timedelta(minutes=15 * (i + 1))
+                lines.append(f"{prefix}{timestamp:%Y-%m-%dT%H:%M:%SZ},{1000.0 + rows - i},{field},koor_processed_data,EE,Meter,OBJ\r\n")
+            cached = "".join(lines)
+            self._tables[(field, rows)] = cached
+        return cached.replace("{table}", str(table))
+
+    def body(self, query: str) -> bytes:
+        rows = 1 if "last()" in query else self.points
+        tables = [self._table(field, i, rows) for i, field in enumerate(_queriedFields(query))]
+        return (_FLUX_HEADER + "".join(tables) + "\r\n").encode()
+
+    def handler(self):
+        stub = self
+        lock = threading.Lock()
+
+        class Handler(_JsonHandler):
+            def do_GET(self):
+                # /ready, /health and /ping
+                if not self._stats():
+                    self._send(200, {"status": "ready"})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if self.path.startswith("/api/v2/write"):
+                    lines = sum(1 for line in body.split(b"\n") if line.strip())
+                    with lock:
+                        stub.writes += 1
+                        stub.lines_written += lines
+                    self._send(204)
+                elif self.path.startswith("/api/v2/query"):
+                    with lock:
+                        stub.queries += 1
+                    self._send(200, stub.body(json.loads(body)["query"]), "text/csv; charset=utf-8")
+                else:
+                    self._send(404, {"message": "not found"})
+
+        Handler.stub = stub
+        return Handler
+
+
+# AURORAL node stand-in: healthcheck, oid lookup and TD registration, with a fixed delay per call
+class AuroralStub(_StubServer):
+    name = "auroral-stub"
+
+    def __init__(self, delay: float = 0.0) -> None:
+        super().__init__()
+        self.delay = delay
+        self.registered = {}  # adapterId -> oid
+        self.calls = 0
+
+    def counters(self) -> dict:
+        return {"calls": self.calls, "registered": len(self.registered)}
+
+    def handler(self):
+        stub = self
+        lock = threading.Lock()
+
+        class Handler(_JsonHandler):
+            def _td(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                return json.loads(self.rfile.read(length)).get('td', {}) if length else {}
+
+            def _wait(self) -> None:
+                with lock:
+                    stub.calls += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+            def do_GET(self):
+                if self._stats():
+                    return
+                self._wait()
+                if self.path.startswith("/api/registration/oid/"):
+                    oid = stub.registered.get(self.path.rsplit("/", 1)[1])
+                    if oid is None:
+                        return self._send(404, {"error": "not registered"})
+                    return self._send(200, {"message": oid})
+                self._send(200, {"message": "ok"})
+
+            def do_POST(self):
+                td = self._td()
+                self._wait()
+                stub.registered[td.get('adapterId')] = "oid-" + str(td.get('adapterId'))
+                self._send(201, {"message": [{"oid": stub.registered[td.get('adapterId')]}]})
+
+            def do_PUT(self):
+                self._td()
+                self._wait()
+                self._send(200, {"message": "updated"})
+
+        Handler.stub = stub
+        return Handler
@@ -0,0 +1,76 @@
+import random
+from datetime import datetime, timedelta
+
+# Synthetic AOCS export generator used by the benchmarks.
+# Produces the same ';' separated layout the AOCS pilot uploads to /processing/upload_csv.
+
+HEADER = ['KOD_OBJEKTU', 'KOD_MERACA', 'NAZOV_MERACA', 'UID', 'ENERGIA', 'PM_TIME', 'POCITADLO']
+ENERGIES = ['EE', 'TEPLO', 'VODA', 'PLYN']
+
+
+def meters(meter_count: int) -> list:
+    result = []
+    for i in range(meter_count):
+        object_code = f"OBJ{i // 10:04d}"
+        meter_code = f"M{i:05d}"
+        uid = str(100000 + i)
+        result.append({
+            'KOD_OBJEKTU': object_code,
+            'KOD_MERACA': meter_code,
+            'NAZOV_MERACA': f"Meter {i} hala {i // 10}",
+            'UID': uid,
+            'ENERGIA': ENERGIES[i % len(ENERGIES)],
+            'id': object_code + "_" + meter_code + "_" + uid,
+        })
+    return result
+
+
+# settings file content with every `enabled_ratio` share of meters enabled
+def settings(meter_list: list, enabled_ratio: float = 0.8, items: int = 1) -> dict:
+    cut = int(len(meter_list) * enabled_ratio)
+    enabled = {}
+    for m in meter_list[:cut]:
+        enabled[m['id']] = {
+            "@type": "adp:EnergyMeter",
+            "title": m['KOD_MERACA'],
+            "NAZOV_MERACA": m['NAZOV_MERACA'],
+            "unit": "kWh",
+        }
+    enabled_ids = list(enabled.keys())
+    per_item = max(1, len(enabled_ids) // max(1, items))
+    item_list = []
+    for i in range(items):
+        item_list.append({
+            "adapterid": f"aocs-item-{i}",
+            "title": f"AOCS item {i}",
+            "description": "Synthetic benchmark item",
+            "location": "Kosice",
+            "properties": enabled_ids[i * per_item:(i + 1) * per_item],
+        })
+    return {
+        "enabled_data_points": enabled,
+        "disabled_data_points": [m['id'] for m in meter_list[cut:]],
+        "items": item_list,
+    }
+
+
+# yield csv lines (without line endings), header first, 15 minute readings per meter
+def csvLines(rows: int, meter_list: list, start: datetime = datetime(2024, 3, 25), seed: int = 42):
+    rnd = random.Random(seed)
+    counters = [rnd.uniform(0, 10000) for _ in meter_list]
+    yield ";".join(HEADER)
+    produced = 0
+    step = 0
+    while produced < rows:
+        timestamp = (start + timedelta(minutes=15 * step)).strftime("%d.%m.%Y %H:%M")
+        for i, m in enumerate(meter_list):
+            if produced >= rows:
+                break
+            counters[i] += rnd.uniform(0, 5)
+            yield ";".join([m['KOD_OBJEKTU'], m['KOD_MERACA'], m['NAZOV_MERACA'], m['UID'], m['ENERGIA'], timestamp, str(round(counters[i], 3))])
+            produced += 1
+        step += 1
+
+
+def csvText(rows: int, meter_count: int = 500, **kwargs) -> str:
+    return "\r\n".join(csvLines(rows, meters(meter_count), **kwargs)) + "\r\n"